@@ -0,0 +1,366 @@
+"""
+Copyright (c) 2010 Patrick Wagstrom
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+# Throughput benchmarks for the sampler, the equation parser and evaluator,
+# the scheduler and the output writer.
+#
+# Usage:
+#     python benchmark.py --save results.json
+#     python benchmark.py --baseline results.json --tolerance 0.1
+#
+# Each case runs in its own process so its peak memory can be measured, and
+# a case that hangs is stopped after a timeout.  The exit status is 1 if any
+# case failed or, with a baseline, got slower by more than the tolerance, so
+# the script can gate changes.
+import os
+import re
+import sys
+import json
+import time
+import Queue
+import timeit
+import shutil
+import platform
+import resource
+import tempfile
+import argparse
+import multiprocessing
+import numpy
+import equationparser
+from stochasticsim import Simulation, RandomValue, CalculatedValue, RandomNormal, RandomUniform, \
+     RandomTriangular, RandomFixed, RandomTabular
+
+ITERATION_COUNTS = (10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7)
+# the depths of the equations used for the parser and evaluator
+EQUATION_DEPTHS = (1, 4, 16, 64)
+# the number of variables in each synthetic model
+DAG_SIZE = 100
+# the number of periods in the run.periods benchmark
+PERIODS = 20
+# cases slower than the baseline by more than this fraction are regressions
+TOLERANCE = 0.10
+# seconds a single case may take, all repeats included, before it is stopped
+CASE_TIMEOUT = 30 * 60
+
+class Case(object):
+    """
+    One benchmark.  The function is called with a number of iterations and
+    returns the number of seconds the timed part took and the number of
+    samples it produced.  Setup outside the timed part isn't counted.
+    """
+    def __init__(self, name, function, max_iterations=None):
+        """
+        @param max_iterations: the largest iteration count worth running,
+                               for cases that go one sample at a time in
+                               Python
+        """
+        object.__init__(self)
+        self.name = name
+        self.function = function
+        self.max_iterations = max_iterations
+
+def timed(function, *args):
+    start = timeit.default_timer()
+    function(*args)
+    return timeit.default_timer() - start
+
+def generators():
+    """
+    @return: a dict of one instance of each RandomNumber
+    """
+    return {"RandomNormal": RandomNormal(10.0, 2.0),
+            "RandomUniform": RandomUniform(1.0, 5.0),
+            "RandomTriangular": RandomTriangular(1.0, 2.0, 5.0),
+            "RandomFixed": RandomFixed(3.0),
+            "RandomTabular": RandomTabular([(0.001, 1000.0), (0.01, RandomUniform(10.0, 20.0)), (0.5, 1.0)])}
+
+def bench_get(name):
+    def run(iterations):
+        gen = generators()[name]
+        def draw():
+            for x in xrange(iterations):
+                gen.get()
+        return timed(draw), iterations
+    return run
+
+def bench_get_many(name):
+    def run(iterations):
+        gen = generators()[name]
+        return timed(gen.get_many, iterations), iterations
+    return run
+
+def nested_equation(depth):
+    """
+    @return: an equation with depth operators, each one nested inside the
+             next, over the variables x0 through x<depth>
+    """
+    equation = "x0"
+    for x in xrange(1, depth + 1):
+        equation = "(%s) %s x%d" % (equation, "+*-/"[x % 4], x)
+    return equation
+
+def bench_parse(depth):
+    def run(iterations):
+        equation = nested_equation(depth)
+        def parse():
+            for x in xrange(iterations):
+                equationparser.parseEquation(equation)
+        return timed(parse), iterations
+    return run
+
+def bench_evaluate(depth):
+    def run(iterations):
+        sim = Simulation(seed=1, iterations=iterations)
+        for x in xrange(depth + 1):
+            sim.add_variable("x%d" % x, RandomValue("x%d" % x, "", RandomUniform(1.0, 2.0)))
+        sim.run()
+        stack = equationparser.parseEquation(nested_equation(depth))
+        def evaluate():
+            for x in xrange(iterations):
+                equationparser.evaluateEquation(stack, x, sim.variables)
+        return timed(evaluate), iterations
+    return run
+
+def tsa_model(iterations):
+    import tsa
+    return tsa.build_simulation(vectorized=True, seed=1, iterations=iterations)
+
+def periods_model(iterations, periods=PERIODS):
+    """
+    @return: tsa.py over several periods, with a running total that reads
+             the period before
+    """
+    sim = tsa_model(iterations)
+    sim.periods = periods
+    sim.add_variable("cumulative_cost", CalculatedValue("cumulative_cost", "", "cumulative_cost[t-1] + net_cost_ait"))
+    return sim
+
+def wide_model(iterations, size=DAG_SIZE):
+    """
+    @return: a simulation of size independent random values, each with its
+             own calculated value
+    """
+    sim = Simulation(vectorized=True, seed=1, iterations=iterations)
+    for x in xrange(size):
+        sim.add_variable("r%d" % x, RandomValue("r%d" % x, "", RandomNormal(0.0, 1.0)))
+        sim.add_variable("c%d" % x, CalculatedValue("c%d" % x, "", "r%d * 2 + 1" % x))
+    return sim
+
+def deep_model(iterations, size=DAG_SIZE):
+    """
+    @return: a simulation with a chain of size calculated values, each one
+             using the one before it
+    """
+    sim = Simulation(vectorized=True, seed=1, iterations=iterations)
+    sim.add_variable("r", RandomValue("r", "", RandomUniform(0.0, 1.0)))
+    sim.add_variable("c0", CalculatedValue("c0", "", "r"))
+    for x in xrange(1, size):
+        sim.add_variable("c%d" % x, CalculatedValue("c%d" % x, "", "c%d * 0.999 + r" % (x - 1)))
+    return sim
+
+def fanin_model(iterations, size=DAG_SIZE):
+    """
+    @return: a simulation where size random values all feed one equation
+    """
+    sim = Simulation(vectorized=True, seed=1, iterations=iterations)
+    for x in xrange(size):
+        sim.add_variable("r%d" % x, RandomValue("r%d" % x, "", RandomTriangular(0.0, 1.0, 3.0)))
+    sim.add_variable("total", CalculatedValue("total", "", " + ".join(["r%d" % x for x in xrange(size)])))
+    return sim
+
+def bench_run(model):
+    def run(iterations):
+        sim = model(iterations)
+        return timed(sim.run), iterations * len(sim.variables) * sim.periods
+    return run
+
+def bench_save_output(iterations):
+    sim = tsa_model(iterations)
+    sim.run()
+    directory = tempfile.mkdtemp(prefix="benchmark")
+    try:
+        return timed(sim.save_output, os.path.join(directory, "out.csv")), iterations * len(sim.variables)
+    finally:
+        shutil.rmtree(directory)
+
+def cases():
+    """
+    @return: every benchmark, in the order they run
+    """
+    result = [Case("tsa", bench_run(tsa_model))]
+    for name in sorted(generators()):
+        result.append(Case("get.%s" % name, bench_get(name), 10 ** 6))
+        result.append(Case("get_many.%s" % name, bench_get_many(name)))
+    for depth in EQUATION_DEPTHS:
+        result.append(Case("parseEquation.depth%d" % depth, bench_parse(depth), 10 ** 3))
+    for depth in EQUATION_DEPTHS:
+        result.append(Case("evaluateEquation.depth%d" % depth, bench_evaluate(depth), 10 ** 5))
+    result.append(Case("run.wide", bench_run(wide_model)))
+    result.append(Case("run.deep", bench_run(deep_model)))
+    result.append(Case("run.fanin", bench_run(fanin_model)))
+    result.append(Case("run.periods", bench_run(periods_model), 10 ** 6))
+    result.append(Case("save_output", bench_save_output, 10 ** 6))
+    return result
+
+def peak_memory():
+    """
+    @return: the peak resident memory of this process in megabytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # bytes on OS X, kilobytes everywhere else
+        return peak / 1024.0 ** 2
+    return peak / 1024.0
+
+def measure(case, iterations, repeat, results):
+    """
+    Runs a case repeat times in this process, keeping the fastest time, and
+    puts the measurements on the results queue.
+    """
+    try:
+        start_memory = peak_memory()
+        seconds, samples = min([case.function(iterations) for x in xrange(repeat)])
+        results.put({"name": case.name,
+                     "iterations": iterations,
+                     "seconds": seconds,
+                     "samples": samples,
+                     "samples_per_sec": samples / max(seconds, 1e-9),
+                     "peak_memory_mb": peak_memory(),
+                     "memory_growth_mb": peak_memory() - start_memory})
+    except Exception, e:
+        results.put({"name": case.name, "iterations": iterations, "error": "%s: %s" % (e.__class__.__name__, e)})
+
+def run_case(case, iterations, repeat=3, timeout=CASE_TIMEOUT):
+    """
+    Runs a case in a child process so the peak memory is its own.  If the
+    child dies without reporting, or is still running after timeout
+    seconds, the case is recorded as failed.
+
+    @return: a dict of the measurements
+    """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure, args=(case, iterations, repeat, results))
+    process.start()
+    deadline = time.time() + timeout
+    result = None
+    while result is None:
+        try:
+            result = results.get(timeout=1.0)
+        except Queue.Empty:
+            if not process.is_alive():
+                # it may have reported just before it exited
+                try:
+                    result = results.get(timeout=1.0)
+                except Queue.Empty:
+                    result = {"name": case.name, "iterations": iterations,
+                              "error": "process exited with code %s" % (process.exitcode)}
+            elif time.time() > deadline:
+                process.terminate()
+                result = {"name": case.name, "iterations": iterations,
+                          "error": "timed out after %d seconds" % (timeout)}
+    process.join()
+    return result
+
+def run_all(sizes=ITERATION_COUNTS, pattern=None, repeat=3, limits=True, timeout=CASE_TIMEOUT):
+    """
+    @param pattern: a regular expression; only cases whose names match it run
+    @param limits: skip iteration counts past the max_iterations of a case
+    @param timeout: the seconds each case may take before it is stopped
+    @return: the report as a dict, ready to be saved as JSON
+    """
+    results = []
+    for case in cases():
+        if pattern is not None and not re.search(pattern, case.name):
+            continue
+        for iterations in sizes:
+            if limits and case.max_iterations is not None and iterations > case.max_iterations:
+                continue
+            result = run_case(case, iterations, repeat, timeout)
+            print format_result(result)
+            sys.stdout.flush()
+            results.append(result)
+    return {"created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": numpy.__version__,
+            "platform": platform.platform(),
+            "results": results}
+
+def format_result(result):
+    if "error" in result:
+        return "%-32s %10d  failed: %s" % (result["name"], result["iterations"], result["error"])
+    return "%-32s %10d  %14.0f samples/sec  %8.1f MB peak" % (result["name"], result["iterations"],
+                                                               result["samples_per_sec"],
+                                                               result["peak_memory_mb"])
+
+def compare(report, baseline, tolerance=TOLERANCE):
+    """
+    Compares the throughput of each case with the same case in a baseline.
+
+    @return: a list of (name, iterations, ratio, regressed) tuples, where the
+             ratio is the current samples/sec over the baseline's
+    """
+    previous = dict(((x["name"], x["iterations"]), x) for x in baseline["results"] if "error" not in x)
+    comparison = []
+    for x in report["results"]:
+        key = (x["name"], x["iterations"])
+        if "error" in x or key not in previous:
+            continue
+        ratio = x["samples_per_sec"] / previous[key]["samples_per_sec"]
+        comparison.append((x["name"], x["iterations"], ratio, ratio < 1.0 - tolerance))
+    return comparison
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the simulation code.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(ITERATION_COUNTS),
+                        help="the iteration counts to run each case at")
+    parser.add_argument("--filter", default=None, help="only run the cases matching this regular expression")
+    parser.add_argument("--repeat", type=int, default=3, help="time each case this many times and keep the best")
+    parser.add_argument("--no-limits", action="store_true",
+                        help="run the per-sample cases at every size, however long it takes")
+    parser.add_argument("--save", default=None, help="write the results to this JSON file")
+    parser.add_argument("--baseline", default=None, help="compare against the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="the slowdown allowed before a case counts as a regression")
+    parser.add_argument("--timeout", type=float, default=CASE_TIMEOUT,
+                        help="stop a case that runs longer than this many seconds and count it as failed")
+    args = parser.parse_args(argv)
+
+    report = run_all(args.sizes, args.filter, args.repeat, not args.no_limits, args.timeout)
+    if args.save:
+        f = open(args.save, "w")
+        json.dump(report, f, indent=1, sort_keys=True)
+        f.close()
+    if args.baseline:
+        f = open(args.baseline)
+        baseline = json.load(f)
+        f.close()
+        comparison = compare(report, baseline, args.tolerance)
+        print
+        for name, iterations, ratio, regressed in comparison:
+            print "%-32s %10d  %6.2fx%s" % (name, iterations, ratio, regressed and "  REGRESSION" or "")
+        if [x for x in comparison if x[3]]:
+            return 1
+    if [x for x in report["results"] if "error" in x]:
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
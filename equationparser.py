@@ -1,93 +1,58 @@
-# SimpleCalc.py
+# equationparser.py
+#
+# Parses the equations of calculated values into an immutable postfix
+# Expression and evaluates or compiles them.  The parser is a small tokenizer
+# and a precedence climbing parser with no module level state, so it can be
+# used from several threads at once.
 #
-# Demonstration of the parsing module, 
 # Sample usage
 #
-#     $ python SimpleCalc.py 
+#     $ python equationparser.py
 #     Type in the string to be parse or 'quit' to exit the program
-#     > g=67.89 + 7/5 
-#     69.29
-#     > g
+#     > g=67.89 + 7/5
 #     69.29
-#     > h=(6*g+8.8)-g 
-#     355.25
-#     > h + 1 
-#     356.25
-#     > 87.89 + 7/5 
-#     89.29
-#     > ans+10
-#     99.29
+#     > max(2, -g) * exp(0)
+#     2.0
 #     > quit
 #     Good bye!
 #
-# 
+# Grammar, loosest binding first:
+#
+#     equation := [ident "="] expr
+#     expr     := term (("+" | "-") term)*
+#     term     := unary (("*" | "/") unary)*
+#     unary    := "-" unary | "+" unary | power
+#     power    := atom ["^" unary]
+#     atom     := number | ident [lag] | function "(" expr ("," expr)* ")" | "(" expr ")"
+#     lag      := "[" "t" ["-" integer] "]"
+#
+# A sign written right against a number is part of the number, as it always
+# has been, so -2 ^ 2 is 4 while -x ^ 2 is -(x ^ 2).
+#
+# x[t-1] is the value of x in the period before, for simulations that run
+# over several periods, and x[t] is the same as x.
+#
+# The postfix tokens are numbers, identifiers, lagged identifiers such as
+# "x[t-1]", the binary operators in opn, UNARY_MINUS and function calls
+# written as name/arity, e.g. "min/2".
 
 from __future__ import division
 
-# Uncomment the line below for readline support on interactive terminal
-# import readline  
 import re
-from pyparsing import Word, alphas, ParseException, Literal, CaselessLiteral \
-, Combine, Optional, nums, Or, Forward, ZeroOrMore, StringEnd, alphanums
 import math
-import string
-import copy
+import numpy
+import __future__
 
 # Debugging flag can be set to either "debug_flag=True" or "debug_flag=False"
 debug_flag=False
 
-exprStack = []
-varStack  = []
-# variables = {}
-
-def pushFirst( str, loc, toks ):
-    exprStack.append( toks[0] )
-
-def assignVar( str, loc, toks ):
-    varStack.append( toks[0] )
-
-# define grammar
-point = Literal('.')
-e = CaselessLiteral('E')
-plusorminus = Literal('+') | Literal('-')
-number = Word(nums) 
-integer = Combine( Optional(plusorminus) + number )
-floatnumber = Combine( integer +
-                       Optional( point + Optional(number) ) +
-                       Optional( e + integer )
-                     )
-
-ident = Word(alphas,alphanums + '_') 
-
-plus  = Literal( "+" )
-minus = Literal( "-" )
-mult  = Literal( "*" )
-div   = Literal( "/" )
-lpar  = Literal( "(" ).suppress()
-rpar  = Literal( ")" ).suppress()
-addop  = plus | minus
-multop = mult | div
-expop = Literal( "^" )
-assign = Literal( "=" )
-
-expr = Forward()
-atom = ( ( e | floatnumber | integer | ident ).setParseAction(pushFirst) | 
-         ( lpar + expr.suppress() + rpar )
-       )
-atom = ( ( floatnumber | integer | ident ).setParseAction(pushFirst) | 
-         ( lpar + expr.suppress() + rpar )
-       )
- 
-
-       
-factor = Forward()
-factor << atom + ZeroOrMore( ( expop + factor ).setParseAction( pushFirst ) )
-        
-term = factor + ZeroOrMore( ( multop + factor ).setParseAction( pushFirst ) )
-expr << term + ZeroOrMore( ( addop + term ).setParseAction( pushFirst ) )
-bnf = Optional((ident + assign).setParseAction(assignVar)) + expr
-
-pattern =  bnf + StringEnd()
+# leading whitespace, then a number, an identifier or any other character
+TOKEN_RE = re.compile(r"(\s*)(?:([0-9]+(?:\.[0-9]*)?(?:[eE][-+]?[0-9]+)?)|([a-zA-Z][a-zA-Z0-9_]*)|(\S))")
+IDENTIFIER_RE = re.compile('^[a-zA-Z][a-zA-Z0-9_]*$')
+INTEGER_RE = re.compile('^[-+]?[0-9]+$')
+LAG_RE = re.compile(r'^([a-zA-Z][a-zA-Z0-9_]*)\[t-([0-9]+)\]$')
+
+UNARY_MINUS = "~"
 
 # map operator symbols to corresponding arithmetic operations
 opn = { "+" : ( lambda a,b: a + b ),
@@ -96,95 +61,481 @@ opn = { "+" : ( lambda a,b: a + b ),
         "/" : ( lambda a,b: a / b ),
         "^" : ( lambda a,b: a ** b ) }
 
+# Each function works on plain numbers, giving the same errors as Python, and
+# on numpy arrays a whole column at a time.
+def isColumn(args):
+  for x in args:
+    if isinstance(x, numpy.ndarray):
+      return True
+  return False
+
+def fmin(*args):
+  if isColumn(args):
+    return reduce(numpy.minimum, args)
+  return min(args)
+
+def fmax(*args):
+  if isColumn(args):
+    return reduce(numpy.maximum, args)
+  return max(args)
+
+def fexp(x):
+  if isinstance(x, numpy.ndarray):
+    return numpy.exp(x)
+  return math.exp(x)
+
+def flog(x):
+  if isinstance(x, numpy.ndarray):
+    return numpy.log(x)
+  return math.log(x)
+
+def fif(condition, a, b):
+  """
+  a wherever condition is non-zero and b everywhere else
+  """
+  if isColumn((condition, a, b)):
+    return numpy.where(numpy.asarray(condition) != 0, a, b)
+  if condition:
+    return a
+  return b
+
+# name -> (function, fewest arguments, most arguments or None for no limit)
+functions = { "min" : ( fmin, 1, None ),
+              "max" : ( fmax, 1, None ),
+              "exp" : ( fexp, 1, 1 ),
+              "log" : ( flog, 1, 1 ),
+              "if"  : ( fif, 3, 3 ) }
+
+class Expression(tuple):
+  """
+  A parsed equation: an immutable tuple of tokens in postfix order.  It can
+  be used anywhere the old list based stacks were, except that it can't be
+  changed.
+  """
+  __slots__ = ()
+
+  @property
+  def postfix(self):
+    return tuple(self)
+
+  @property
+  def variables(self):
+    """
+    the names of the variables the equation uses, in order of first use
+    """
+    return getVariables(self)
+
+  def __repr__(self):
+    return "Expression(%s)" % (tuple.__repr__(self))
+
+def functionToken(op):
+  """
+  @return: the (name, arity) of a function call token, or None for any
+           other token
+  """
+  if "/" in op and op != "/":
+    name, arity = op.split("/")
+    return name, int(arity)
+  return None
+
+def tokenArity(op):
+  """
+  @return: how many operands a postfix token takes off the stack, which is
+           0 for numbers and variables
+  """
+  if op in opn:
+    return 2
+  if op == UNARY_MINUS:
+    return 1
+  call = functionToken(op)
+  if call is not None:
+    return call[1]
+  return 0
+
+def applyToken(op, args):
+  """
+  Applies an operator or function token to its evaluated operands.
+  """
+  if op in opn:
+    return opn[op](args[0], args[1])
+  if op == UNARY_MINUS:
+    return -args[0]
+  return functions[functionToken(op)[0]][0](*args)
+
+def tokenize(input_string):
+  """
+  @return: a list of (space, number, identifier, other) tuples, one per
+           token, where only one of the last three is set and space is
+           whatever whitespace came before the token
+  """
+  return TOKEN_RE.findall(input_string)
+
+def tokenText(token):
+  return token[1] or token[2] or token[3]
+
+# binding power of the operators the parser keeps on its stack; "(" and
+# function calls are never popped by an operator
+stackPrecedence = { "+" : 1,
+                    "-" : 1,
+                    "*" : 2,
+                    "/" : 2,
+                    UNARY_MINUS : 3,
+                    "^" : 4,
+                    "(" : 0 }
+
+class Parser(object):
+  """
+  Parses a single equation.  Each parse has its own Parser, so any number
+  of them can run at once.
+
+  This is the shunting yard form of precedence climbing: one pass over the
+  tokens, keeping the operators that are still waiting for their right hand
+  side on a stack.
+  """
+  def __init__(self, input_string):
+    object.__init__(self)
+    self.input_string = input_string
+    self.tokens = tokenize(input_string)
+    self.target = None
+
+  def error(self, message):
+    raise Exception("Unable to parse equation '%s': %s" % (self.input_string, message))
+
+  def expected(self, what, pos):
+    if pos < len(self.tokens):
+      self.error("expected %s but found '%s'" % (what, tokenText(self.tokens[pos])))
+    self.error("expected %s but found the end" % (what))
+
+  def parse(self):
+    """
+    @return: the equation as an Expression
+    """
+    tokens = self.tokens
+    count = len(tokens)
+    pos = 0
+    # an optional assignment, which isn't part of the expression
+    if count > 1 and tokens[0][2] and tokens[1][3] == "=":
+      self.target = tokens[0][2]
+      pos = 2
+    output = []
+    # operators, and [name, arguments] lists for open function calls
+    stack = []
+    operand = True
+    while pos < count:
+      space, number, ident, op = tokens[pos]
+      pos = pos + 1
+      if operand:
+        if number:
+          # exponents have always been written with a capital E
+          output.append(number.replace("e", "E"))
+          operand = False
+        elif ident:
+          if pos < count and tokens[pos][3] == "(":
+            if ident not in functions:
+              self.error("unknown function %s" % (ident))
+            stack.append([ident, 1])
+            pos = pos + 1
+          elif pos < count and tokens[pos][3] == "[":
+            pos = self.lag(ident, pos, output)
+            operand = False
+          else:
+            output.append(ident)
+            operand = False
+        elif op == "(":
+          stack.append("(")
+        elif op == "-" or op == "+":
+          if pos < count and tokens[pos][1] and not tokens[pos][0]:
+            # a sign written against a number is part of it
+            output.append(op + tokens[pos][1].replace("e", "E"))
+            pos = pos + 1
+            operand = False
+          elif op == "-":
+            stack.append(UNARY_MINUS)
+        else:
+          self.expected("a value", pos - 1)
+      elif op in opn:
+        precedence = stackPrecedence[op]
+        # everything else groups to the left, but ^ groups to the right
+        if op == "^":
+          precedence = precedence + 1
+        while stack and stack[-1].__class__ is not list and stackPrecedence[stack[-1]] >= precedence:
+          output.append(stack.pop())
+        stack.append(op)
+        operand = True
+      elif op == ")" or op == ",":
+        while stack and stack[-1].__class__ is not list and stack[-1] != "(":
+          output.append(stack.pop())
+        if not stack or (op == "," and stack[-1] == "("):
+          self.expected("an operator", pos - 1)
+        if op == ",":
+          stack[-1][1] = stack[-1][1] + 1
+          operand = True
+        else:
+          top = stack.pop()
+          if top != "(":
+            self.close(top, output)
+      else:
+        self.expected("an operator", pos - 1)
+    if operand:
+      self.expected("a value", pos)
+    while stack:
+      top = stack.pop()
+      if top.__class__ is list or top == "(":
+        self.expected("')'", pos)
+      output.append(top)
+    return Expression(output)
+
+  def lag(self, ident, pos, output):
+    """
+    Reads the [t-n] after an identifier, whose "[" is at pos.
+
+    @return: the position after the closing "]"
+    """
+    tokens = self.tokens
+    text = "".join([tokenText(x) for x in tokens[pos:pos + 5]])
+    if pos + 2 < len(tokens) and tokens[pos + 1][2] == "t" and tokens[pos + 2][3] == "]":
+      output.append(ident)
+      return pos + 3
+    if (pos + 4 < len(tokens) and tokens[pos + 1][2] == "t" and tokens[pos + 2][3] == "-" and
+        INTEGER_RE.search(tokens[pos + 3][1]) and tokens[pos + 4][3] == "]"):
+      if int(tokens[pos + 3][1]) == 0:
+        output.append(ident)
+      else:
+        output.append("%s[t-%d]" % (ident, int(tokens[pos + 3][1])))
+      return pos + 5
+    self.error("expected a period such as [t-1] after %s but found '%s'" % (ident, text))
+
+  def close(self, call, output):
+    """
+    Adds the token for a function call whose closing bracket was just read.
+
+    @param call: the [name, arguments] entry the call had on the stack
+    """
+    name, arguments = call
+    fewest, most = functions[name][1:]
+    if arguments < fewest or (most is not None and arguments > most):
+      self.error("%s can't take %d arguments" % (name, arguments))
+    output.append("%s/%d" % (name, arguments))
+
 # Recursive function that evaluates the stack
 def evaluateStack(s, iterround=0, invariables={}):
   op = s.pop()
-  if op in "+-*/^":
-    op2 = evaluateStack(s, iterround=iterround, invariables=invariables)
-    op1 = evaluateStack(s, iterround=iterround, invariables=invariables)
-    return opn[op]( op1, op2 )
+  arity = tokenArity(op)
+  if arity:
+    args = [evaluateStack(s, iterround=iterround, invariables=invariables) for x in xrange(arity)]
+    args.reverse()
+    return applyToken(op, args)
   elif op == "PI":
     return math.pi
   elif op == "E":
     return math.e
-  elif re.search('^[a-zA-Z][a-zA-Z0-9_]*$',op):
+  elif IDENTIFIER_RE.search(op) or LAG_RE.search(op):
     if invariables.has_key(op):
       # print "looking up %s - round %d" % (op, iterround)
       return invariables[op].calculated_values[iterround]
     else:
       raise Exception("Undefined Variable: " + op)
-  elif re.search('^[-+]?[0-9]+$',op):
+  elif INTEGER_RE.search(op):
+    return long( op )
+  else:
+    return float( op )
+
+# Same walk as evaluateStack, but identifiers resolve to whole columns so the
+# operators in opn run once per equation instead of once per iteration.
+def evaluateColumnStack(s, columns={}):
+  op = s.pop()
+  arity = tokenArity(op)
+  if arity:
+    args = [evaluateColumnStack(s, columns=columns) for x in xrange(arity)]
+    args.reverse()
+    return applyToken(op, args)
+  elif op == "PI":
+    return math.pi
+  elif op == "E":
+    return math.e
+  elif IDENTIFIER_RE.search(op) or LAG_RE.search(op):
+    if columns.has_key(op):
+      return columns[op]
+    else:
+      raise Exception("Undefined Variable: " + op)
+  elif INTEGER_RE.search(op):
     return long( op )
   else:
     return float( op )
 
+# Python source for each operator, used when compiling an equation
+pyopn = { "+" : "+",
+          "-" : "-",
+          "*" : "*",
+          "/" : "/",
+          "^" : "**" }
+
+# Python precedence of each operator.  Only the brackets the precedence needs
+# are written out, since the Python 2 parser overflows on deeply nested ones,
+# e.g. a sum of a hundred variables.
+pyprec = { "+" : 1,
+           "-" : 1,
+           "*" : 2,
+           "/" : 2,
+           UNARY_MINUS : 3,
+           "^" : 4 }
+ATOM_PRECEDENCE = 5
+
+# Recursive function that turns the stack into the source of a Python
+# expression.  Variables become positional arguments and numbers become
+# entries in the constants dict so they keep the same types evaluateStack
+# would give them.  Returns the source and its precedence.
+def compileStack(s, arguments, constants):
+  op = s.pop()
+  if op in opn:
+    op2, prec2 = compileStack(s, arguments, constants)
+    op1, prec1 = compileStack(s, arguments, constants)
+    prec = pyprec[op]
+    # ^ groups to the right and everything else to the left, the same as
+    # in Python, so a bracket is only needed on the other side
+    if prec1 < prec or (prec1 == prec and op == "^"):
+      op1 = "(%s)" % op1
+    if prec2 < prec or (prec2 == prec and op != "^"):
+      op2 = "(%s)" % op2
+    return "%s %s %s" % (op1, pyopn[op], op2), prec
+  elif op == UNARY_MINUS:
+    op1, prec1 = compileStack(s, arguments, constants)
+    if prec1 < pyprec[op]:
+      op1 = "(%s)" % op1
+    return "-%s" % op1, pyprec[op]
+  elif functionToken(op) is not None:
+    name, arity = functionToken(op)
+    args = [compileStack(s, arguments, constants)[0] for x in xrange(arity)]
+    args.reverse()
+    constants["_f" + name] = functions[name][0]
+    return "_f%s(%s)" % (name, ", ".join(args)), ATOM_PRECEDENCE
+  elif op == "PI":
+    value = math.pi
+  elif op == "E":
+    value = math.e
+  elif IDENTIFIER_RE.search(op) or LAG_RE.search(op):
+    if op not in arguments:
+      arguments.append(op)
+    return "_v%d" % arguments.index(op), ATOM_PRECEDENCE
+  elif INTEGER_RE.search(op):
+    value = long( op )
+  else:
+    value = float( op )
+  name = "_k%d" % len(constants)
+  constants[name] = value
+  return name, ATOM_PRECEDENCE
+
 def getVariables(parse_results):
-  return [x for x in parse_results if x[0] in string.letters and x != "PI" and x != "E"]
+  """
+  @return: the identifiers in a parsed equation other than PI and E, each
+           once, in order of first use
+  """
+  names = []
+  for x in parse_results:
+    if IDENTIFIER_RE.search(x) and x != "PI" and x != "E" and x not in names:
+      names.append(x)
+  return names
+
+def getLags(parse_results):
+  """
+  @return: a (token, name, periods back) tuple for each lagged identifier in
+           a parsed equation, each once, in order of first use
+  """
+  lags = []
+  for x in parse_results:
+    match = LAG_RE.search(x)
+    if match and x not in [y[0] for y in lags]:
+      lags.append((x, match.group(1), int(match.group(2))))
+  return lags
 
 def parseEquation(input_string):
-  global exprStack, varStack, variables
-  exprStack, varStack, variables = [[], [], {}]
-  L = pattern.parseString(input_string)
-  return exprStack
+  """
+  Parse an equation.
+
+  @return: an Expression, which is a tuple of the tokens in postfix order
+  """
+  return Parser(input_string).parse()
 
 def evaluateEquation(exprstack, iterround=0, invariables={}):
-  global exprStack, varStack, variables
-  exprStack, varStack, variables = [[], [], {}]
-  exprStack = copy.copy(exprstack)
-  varStack = []
-  variables = {}
-  return evaluateStack(exprStack, iterround=iterround, invariables=invariables)
+  return evaluateStack(list(exprstack), iterround=iterround, invariables=invariables)
+
+def evaluateColumn(exprstack, columns={}):
+  """
+  Evaluate a parsed equation over entire columns at once.
+
+  @param exprstack: the postfix stack returned by parseEquation
+  @param columns: a dict mapping variable names to numpy arrays of samples
+  @return: an array of results, or a plain number if the equation has no
+           variables in it
+  """
+  return evaluateColumnStack(list(exprstack), columns=columns)
+
+def compileEquation(exprstack):
+  """
+  Compile a parsed equation into a plain Python function so it only needs to
+  be interpreted once.
+
+  The returned function takes one positional argument per variable, and
+  per lagged variable, in the order given by its C{variables} attribute,
+  and returns the same value evaluateEquation would for those inputs.  The
+  generated source is kept in its C{source} attribute.
+
+  @param exprstack: the postfix stack returned by parseEquation
+  """
+  arguments = getVariables(exprstack)
+  constants = {}
+  body = compileStack(list(exprstack), arguments, constants)[0]
+  source = "lambda %s: %s" % (", ".join(["_v%d" % x for x in xrange(len(arguments))]), body)
+  code = compile(source, "<equation>", "eval", __future__.division.compiler_flag, True)
+  func = eval(code, constants)
+  func.variables = arguments
+  func.source = source
+  return func
 
 if __name__ == '__main__':
+  # the values typed in so far, in the form evaluateEquation looks them up
+  class StoredValue(object):
+    def __init__(self, value):
+      self.calculated_values = [value]
+
   variables = {}
   # input_string
   input_string=''
-  
+
   # Display instructions on how to quit the program
   print "Type in the string to be parse or 'quit' to exit the program"
   input_string = raw_input("> ")
-  
-  while input_string != 'quit':
-    # Start with a blank exprStack and a blank varStack
-    exprStack = []
-    varStack  = []
-    variables = {} 
-
 
+  while input_string != 'quit':
     if input_string != '':
       # try parsing the input string
       try:
-        L=pattern.parseString( input_string )
-      except ParseException,err:
-        L=['Parse Failure',input_string]
-      
-      # show result of parsing the input string
-      if debug_flag: print input_string, "->", L
-      if len(L)==0 or L[0] != 'Parse Failure':
-        if debug_flag: print "exprStack=", exprStack
-  
-        # calculate result , store a copy in ans , display the result to user
-        print "p1"
-        result=evaluateStack(exprStack, {})
-        variables['ans']=result
-        print "p2"
-        print result
-  
-        # Assign result to a variable if required
-        if debug_flag: print "var=",varStack
-        if len(varStack)==1:
-          variables[varStack.pop()]=result
-        if debug_flag: print "variables=",variables
-      else:
+        parser = Parser( input_string )
+        expression = parser.parse()
+      except Exception, err:
         print 'Parse Failure'
-        print err.line
-        print " "*(err.column-1) + "^"
         print err
-  
+        expression = None
+
+      if expression is not None:
+        if debug_flag: print input_string, "->", expression
+
+        # calculate result , store a copy in ans , display the result to user
+        try:
+          result = evaluateEquation(expression, 0, variables)
+        except Exception, err:
+          print err
+        else:
+          print result
+          variables['ans'] = StoredValue(result)
+
+          # Assign result to a variable if required
+          if parser.target is not None:
+            variables[parser.target] = StoredValue(result)
+          if debug_flag: print "variables=", variables
+
     # obtain new input string
     input_string = raw_input("> ")
-     
+
   # if user type 'quit' then say goodbye
   print "Good bye!"
-
-
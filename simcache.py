@@ -0,0 +1,185 @@
+"""
+Copyright (c) 2010 Patrick Wagstrom
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+# An on-disk cache of calculated columns.  Entries are addressed by the hash
+# of a variable's definition and everything upstream of it (see
+# Simulation.node_hashes), the seed and the range of iterations, so a cached
+# chunk is only ever reused where it would be calculated exactly the same.
+#
+# Usage:
+#     sim.cache = simcache.ResultCache("cache/", max_bytes=2 * 1024 ** 3)
+#     sim.run()
+import os
+import json
+import random
+import hashlib
+import numpy
+from stochasticsim import CHUNK_SIZE
+
+# the default size limit of a cache, in bytes
+CACHE_SIZE = 1024 ** 3
+# once over its limit a cache is trimmed to this fraction of it, so the
+# directory doesn't have to be scanned again on every write
+LOW_WATER = 0.9
+SEED_FILE = "seed.json"
+
+class ResultCache(object):
+    """
+    Keeps one .npy file per chunk of a variable, spread over subdirectories
+    by the first two characters of the entry hash.  Files are written under
+    a temporary name and renamed into place, so an interrupted write never
+    leaves a partial entry, and several processes can share a cache.
+
+    Reading an entry touches its modification time, and when the cache
+    grows past max_bytes the entries that were used longest ago are deleted
+    first.
+    """
+    def __init__(self, directory, max_bytes=CACHE_SIZE, chunk_size=CHUNK_SIZE):
+        """
+        @param max_bytes: the most disk space the entries should take up
+        @param chunk_size: runs are cached in pieces of this many iterations,
+                           which is also how often a long run checkpoints
+        """
+        object.__init__(self)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.scan()
+
+    def scan(self):
+        """
+        Rebuilds the index of entries from the files in the directory.
+        """
+        self.entries = {}
+        for root, dirs, files in os.walk(self.directory):
+            for x in files:
+                if x.endswith(".npy"):
+                    path = os.path.join(root, x)
+                    try:
+                        info = os.stat(path)
+                    except OSError:
+                        continue
+                    self.entries[path] = (info.st_mtime, info.st_size)
+        self.total = sum([x[1] for x in self.entries.itervalues()])
+
+    def path(self, node, seed, start, stop):
+        digest = hashlib.md5("%s:%s:%d:%d" % (node, seed, start, stop)).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + ".npy")
+
+    def get(self, node, seed, start, stop):
+        """
+        @param node: the hash of the variable from Simulation.node_hashes
+        @return: the cached values for iterations start through stop - 1,
+                 or None if they aren't in the cache
+        """
+        path = self.path(node, seed, start, stop)
+        try:
+            os.utime(path, None)
+            values = numpy.load(path)
+        except (IOError, OSError, ValueError):
+            self.misses = self.misses + 1
+            return None
+        if len(values) != stop - start:
+            self.misses = self.misses + 1
+            return None
+        self.hits = self.hits + 1
+        if path in self.entries:
+            self.entries[path] = (os.path.getmtime(path), self.entries[path][1])
+        return values
+
+    def put(self, node, seed, start, stop, values):
+        """
+        Saves the values for iterations start through stop - 1.  Constant
+        columns, such as those of RandomFixed values, are cheaper to make
+        than to load and aren't saved.
+        """
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if values.strides == (0,):
+            return
+        path = self.path(node, seed, start, stop)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # another process made it first
+                pass
+        temp = "%s.%d.tmp" % (path, os.getpid())
+        f = open(temp, "wb")
+        try:
+            numpy.save(f, values)
+        finally:
+            f.close()
+        os.rename(temp, path)
+        info = os.stat(path)
+        self.total = self.total - self.entries.get(path, (0, 0))[1] + info.st_size
+        self.entries[path] = (info.st_mtime, info.st_size)
+        if self.total > self.max_bytes:
+            self.evict()
+
+    def evict(self, limit=None):
+        """
+        Deletes the least recently used entries until the cache is under
+        limit bytes, which defaults to LOW_WATER of max_bytes.
+        """
+        if limit is None:
+            limit = int(self.max_bytes * LOW_WATER)
+        # other processes may have added or used entries since the last scan
+        self.scan()
+        for path, (mtime, size) in sorted(self.entries.items(), key=lambda x: x[1][0]):
+            if self.total <= limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            del self.entries[path]
+            self.total = self.total - size
+
+    def clear(self):
+        self.evict(0)
+
+    def default_seed(self):
+        """
+        Gives simulations without a seed the same one every time the cache
+        is used, picking and remembering it the first time.  Re-running a
+        model, or one where only part of it changed, then finds what it can
+        in the cache, and a run that was interrupted resumes.
+        """
+        path = os.path.join(self.directory, SEED_FILE)
+        if os.path.exists(path):
+            f = open(path)
+            try:
+                return json.load(f)["seed"]
+            except (ValueError, KeyError):
+                pass
+            finally:
+                f.close()
+        seed = random.SystemRandom().getrandbits(64)
+        temp = "%s.%d.tmp" % (path, os.getpid())
+        f = open(temp, "w")
+        json.dump({"seed": seed}, f)
+        f.close()
+        os.rename(temp, path)
+        return seed
@@ -0,0 +1,483 @@
+"""
+Copyright (c) 2010 Patrick Wagstrom
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+# Models written as data rather than Python.  A model file is JSON, YAML or
+# TOML (YAML needs PyYAML and TOML the toml package) holding a table of
+# variables, each with either a distribution or an equation:
+#
+#     {"outputs": ["net_cost_ait"],
+#      "variables": {
+#        "value_human_life": {"name": "Value of a Human Life",
+#                             "units": "Dollars",
+#                             "distribution": {"type": "fixed", "value": 6900000},
+#                             "comments": "Source: EPA 2008"},
+#        "risk_vpi": {"name": "Risk of Dying from a Violent Passenger Incident",
+#                     "units": "Percentage",
+#                     "distribution": {"type": "normal", "mean": 2.2e-08, "stdev": 3e-09}},
+#        "cost_vpi_fatalities": {"name": "Expected cost of a VPI in a year",
+#                                "units": "Dollars/Year",
+#                                "equation": "risk_vpi * value_human_life"}}}
+#
+# A distribution that is just a number is fixed.  For importance sampling a
+# normal distribution can have a shift and a scale, and a tabular one a
+# bias such as {"2": 0.1}, mapping row numbers to the chance to draw them
+# with.  If outputs is given, or optimize is true, the simulation gets an
+# optimized plan (see simplan).
+# A model can set periods for a simulation over several periods, where an
+# equation can use x[t-1], and a variable can set the initial value that
+# gives in the first period.
+#
+# Usage:
+#     sim = simmodel.load_model("tsa.json", cache="models/", vectorized=True)
+#     sim.run()
+#
+# With a cache directory the parsed, sorted and optimized model is pickled
+# under the hash of the file, and loading the same file again builds the
+# simulation from that without parsing any equations.
+import os
+import json
+import hashlib
+import collections
+import cPickle
+import equationparser
+import simplan
+from stochasticsim import RandomValue, RandomNumber, RandomFixed, RandomNormal, RandomUniform, \
+    RandomTriangular, RandomTabular, CalculatedValue, Simulation
+
+# distribution type -> (RandomNumber class, its parameters in order)
+DISTRIBUTIONS = { "fixed" : ( RandomFixed, ("value",) ),
+                  "normal" : ( RandomNormal, ("mean", "stdev") ),
+                  "uniform" : ( RandomUniform, ("low", "high") ),
+                  "triangular" : ( RandomTriangular, ("low", "med", "high") ),
+                  "tabular" : ( RandomTabular, ("table",) ) }
+# distribution type -> the parameters that can be left out, which set up
+# importance sampling
+OPTIONAL_PARAMETERS = { "normal" : ("shift", "scale"),
+                        "tabular" : ("bias",) }
+FORMATS = { ".json" : "json",
+            ".yaml" : "yaml",
+            ".yml" : "yaml",
+            ".toml" : "toml" }
+MODEL_KEYS = ("name", "description", "periods", "outputs", "optimize", "variables")
+VARIABLE_KEYS = ("name", "units", "comments", "initial", "distribution", "equation")
+# changes whenever the compiled form does, so old cache entries are ignored
+COMPILED_VERSION = "2"
+
+def load_model(path, cache=None, **kwargs):
+    """
+    Reads a model file and builds its simulation.
+
+    @param cache: a directory for compiled models, or a ModelCache
+    @param kwargs: passed on to Simulation
+    @return: the Simulation
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FORMATS:
+        raise Exception("Unknown model format %s, expected one of %s" % (extension, ", ".join(sorted(FORMATS))))
+    f = open(path, "rb")
+    try:
+        text = f.read()
+    finally:
+        f.close()
+    return loads(text, FORMATS[extension], cache, path, **kwargs)
+
+def loads(text, format="json", cache=None, source="model", **kwargs):
+    """
+    Builds the simulation for the text of a model file.
+
+    @param source: where the text came from, for error messages
+    """
+    if cache is not None and not isinstance(cache, ModelCache):
+        cache = ModelCache(cache)
+    key = None
+    if cache is not None:
+        key = cache.key(text, format, kwargs.get("vectorized", False), kwargs.get("periods"))
+        state = cache.get(key)
+        if state is not None:
+            return from_compiled(state, **kwargs)
+    simulation = build_simulation(read_spec(text, format, source), source, **kwargs)
+    if cache is not None:
+        cache.put(key, compiled(simulation))
+    return simulation
+
+def read_spec(text, format, source="model"):
+    """
+    @return: the model file parsed into dicts and lists
+    """
+    try:
+        if format == "json":
+            return json.loads(text, object_pairs_hook=collections.OrderedDict)
+        if format == "yaml":
+            try:
+                import yaml
+            except ImportError:
+                raise Exception("Reading YAML models needs PyYAML")
+            return yaml.safe_load(text)
+        if format == "toml":
+            try:
+                import toml
+            except ImportError:
+                raise Exception("Reading TOML models needs the toml package")
+            return toml.loads(text)
+    except ValueError, e:
+        # json, and both toml packages, raise ValueErrors
+        raise Exception("Unable to read model %s: %s" % (source, e))
+    raise Exception("Unknown model format %s" % (format))
+
+def build_simulation(spec, source="model", **kwargs):
+    """
+    Checks a model and builds its simulation.  Every problem found is
+    reported at once.
+
+    @param spec: the model as read by read_spec
+    @param kwargs: passed on to Simulation, and override the periods of
+                   the model
+    @return: the Simulation
+    """
+    if not isinstance(spec, dict) or not isinstance(spec.get("variables"), dict):
+        raise Exception("Invalid model %s: expected a table with a variables table in it" % (source))
+    errors = ["unknown setting %s" % (key) for key in spec if key not in MODEL_KEYS]
+    if "periods" in spec and (not isinstance(spec["periods"], (int, long)) or isinstance(spec["periods"], bool) or
+                              spec["periods"] < 1):
+        errors.append("periods must be a whole number of at least 1")
+    elif "periods" in spec:
+        kwargs.setdefault("periods", spec["periods"])
+    simulation = Simulation(**kwargs)
+    for varname, entry in spec["variables"].iteritems():
+        variable = build_variable(varname, entry, errors)
+        if variable is not None:
+            simulation.add_variable(varname, variable)
+    for varname, deps in simulation.dependencies(lagged=True).iteritems():
+        for x in deps:
+            if x not in spec["variables"]:
+                errors.append("%s: unknown variable %s" % (varname, x))
+
+    outputs = spec.get("outputs")
+    if outputs is not None:
+        if not isinstance(outputs, list) or [x for x in outputs if not isinstance(x, basestring)]:
+            errors.append("outputs must be a list of variable names")
+        else:
+            errors.extend(["outputs: unknown variable %s" % (x) for x in outputs if x not in spec["variables"]])
+    if spec.get("optimize") not in (None, True, False):
+        errors.append("optimize must be true or false")
+
+    if not errors:
+        try:
+            simulation.schedule()
+        except Exception, e:
+            errors.append(str(e))
+    if errors:
+        raise Exception("Invalid model %s:\n  %s" % (source, "\n  ".join(errors)))
+
+    if outputs is not None and spec.get("optimize") is not False:
+        simplan.optimize(simulation, outputs)
+    elif spec.get("optimize"):
+        simplan.optimize(simulation)
+    return simulation
+
+def build_variable(varname, entry, errors):
+    """
+    @return: the RandomValue or CalculatedValue for one entry of the
+             variables table, or None if it has problems, which are added
+             to errors
+    """
+    if not equationparser.IDENTIFIER_RE.search(varname) or varname in ("PI", "E"):
+        errors.append("%s: not a valid variable name" % (varname))
+        return None
+    if not isinstance(entry, dict):
+        errors.append("%s: expected a table" % (varname))
+        return None
+    count = len(errors)
+    errors.extend(["%s: unknown setting %s" % (varname, key) for key in entry if key not in VARIABLE_KEYS])
+    for key in ("name", "units", "comments"):
+        if key in entry and not isinstance(entry[key], basestring):
+            errors.append("%s: %s must be a string" % (varname, key))
+    if "initial" in entry and not is_number(entry["initial"]):
+        errors.append("%s: initial must be a number" % (varname))
+    if ("distribution" in entry) == ("equation" in entry):
+        errors.append("%s: needs either a distribution or an equation" % (varname))
+        return None
+    name = entry.get("name", varname)
+    units = entry.get("units", "")
+    comments = entry.get("comments")
+    if "equation" in entry:
+        if not isinstance(entry["equation"], basestring):
+            errors.append("%s: equation must be a string" % (varname))
+            return None
+        try:
+            variable = CalculatedValue(name, units, entry["equation"], comments, initial=entry.get("initial", 0.0))
+        except Exception, e:
+            errors.append("%s: %s" % (varname, e))
+            return None
+    else:
+        gen = build_generator(entry["distribution"], varname, errors)
+        if gen is None:
+            return None
+        variable = RandomValue(name, units, gen, comments, entry.get("initial", 0.0))
+    if len(errors) > count:
+        return None
+    return variable
+
+def build_generator(spec, where, errors):
+    """
+    @param where: what the distribution belongs to, for errors
+    @return: the RandomNumber for a distribution, or None if it has
+             problems, which are added to errors
+    """
+    if is_number(spec):
+        return RandomFixed(spec)
+    if not isinstance(spec, dict) or spec.get("type") not in DISTRIBUTIONS:
+        errors.append("%s: distribution needs a type, one of %s" % (where, ", ".join(sorted(DISTRIBUTIONS))))
+        return None
+    cls, parameters = DISTRIBUTIONS[spec["type"]]
+    optional = OPTIONAL_PARAMETERS.get(spec["type"], ())
+    count = len(errors)
+    for key in spec:
+        if key != "type" and key not in parameters and key not in optional:
+            errors.append("%s: unknown %s parameter %s" % (where, spec["type"], key))
+    for key in parameters:
+        if key not in spec:
+            errors.append("%s: %s distribution needs %s" % (where, spec["type"], key))
+        elif key != "table" and not is_number(spec[key]):
+            errors.append("%s: %s must be a number" % (where, key))
+    for key in optional:
+        if key in spec and key != "bias" and not is_number(spec[key]):
+            errors.append("%s: %s must be a number" % (where, key))
+    options = dict((x, spec[x]) for x in optional if x in spec)
+    if "bias" in options:
+        options["bias"] = build_bias(spec["bias"], where, errors)
+    if len(errors) > count:
+        return None
+    try:
+        if cls is RandomTabular:
+            table = build_table(spec["table"], where, errors)
+            if table is None:
+                return None
+            return RandomTabular(table, **options)
+        return cls(*[spec[x] for x in parameters], **options)
+    except Exception, e:
+        errors.append("%s: %s" % (where, e))
+        return None
+
+def build_table(rows, where, errors):
+    """
+    @return: the (chance, value) rows of a tabular distribution, where a
+             value may itself be a distribution
+    """
+    if not isinstance(rows, list):
+        errors.append("%s: table must be a list of [chance, value] rows" % (where))
+        return None
+    count = len(errors)
+    table = []
+    for row, val in enumerate(rows):
+        if not isinstance(val, list) or len(val) != 2 or not is_number(val[0]):
+            errors.append("%s: row %d of the table is not a [chance, value] pair" % (where, row))
+        elif is_number(val[1]):
+            table.append((val[0], val[1]))
+        else:
+            gen = build_generator(val[1], "%s row %d" % (where, row), errors)
+            if gen is not None:
+                table.append((val[0], gen))
+    if len(errors) > count:
+        return None
+    return table
+
+def build_bias(spec, where, errors):
+    """
+    @return: the bias of a tabular distribution as a dict mapping row
+             numbers to chances, or None if it has problems
+    """
+    if not isinstance(spec, dict):
+        errors.append("%s: bias must map row numbers to chances" % (where))
+        return None
+    bias = {}
+    for key, val in sorted(spec.iteritems()):
+        if not isinstance(key, (int, long, basestring)) or not str(key).isdigit():
+            errors.append("%s: bias row %s is not a row number" % (where, key))
+        elif not is_number(val):
+            errors.append("%s: the bias for row %s must be a number" % (where, key))
+        else:
+            bias[int(key)] = val
+    return bias
+
+def is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+def compiled(simulation):
+    """
+    @return: everything needed to rebuild a simulation without parsing or
+             sorting it again, as plain data that can be pickled
+    """
+    variables = []
+    for key in simulation.schedule():
+        variable = simulation.variables[key]
+        entry = {"varname": key, "name": variable.name, "units": variable.units, "comments": variable.comments,
+                 "initial": variable.initial}
+        if isinstance(variable, CalculatedValue):
+            entry["equation"] = variable.equation
+            entry["parsed"] = tuple(variable.parsed_equation)
+        else:
+            entry["distribution"] = generator_spec(variable.gen)
+        variables.append(entry)
+    return {"variables": variables,
+            "periods": simulation.periods,
+            "order": list(simulation.schedule()),
+            "plan": simulation.plan is not None and simulation.plan.state() or None}
+
+def from_compiled(state, **kwargs):
+    """
+    Rebuilds a simulation from what compiled returned.
+    """
+    kwargs.setdefault("periods", state["periods"])
+    simulation = Simulation(**kwargs)
+    for entry in state["variables"]:
+        if "equation" in entry:
+            variable = CalculatedValue(entry["name"], entry["units"], entry["equation"], entry["comments"],
+                                       entry["parsed"], entry["initial"])
+        else:
+            gen = build_generator(entry["distribution"], entry["varname"], [])
+            variable = RandomValue(entry["name"], entry["units"], gen, entry["comments"], entry["initial"])
+        simulation.add_variable(entry["varname"], variable)
+    simulation.order = list(state["order"])
+    if state["plan"] is not None:
+        simplan.restore(simulation, state["plan"])
+    return simulation
+
+def generator_spec(gen):
+    """
+    @return: the distribution table for a RandomNumber
+    """
+    for key, (cls, parameters) in DISTRIBUTIONS.iteritems():
+        if gen.__class__ is cls and cls is RandomFixed:
+            return collections.OrderedDict([("type", key), ("value", gen.val)])
+        if gen.__class__ is cls and cls is RandomTabular:
+            spec = collections.OrderedDict([("type", key),
+                                            ("table", [[x[0], isinstance(x[1], RandomNumber) and
+                                                        generator_spec(x[1]) or x[1]] for x in gen.table])])
+            if gen.bias is not None:
+                spec["bias"] = collections.OrderedDict([(str(x), y) for x, y in sorted(gen.bias.iteritems())])
+            return spec
+        if gen.__class__ is cls:
+            spec = collections.OrderedDict([("type", key)] + [(x, getattr(gen, x)) for x in parameters])
+            if gen.biased():
+                spec.update([(x, getattr(gen, x)) for x in OPTIONAL_PARAMETERS.get(key, ())])
+            return spec
+    raise Exception("Unable to describe a %s as a distribution" % (gen.__class__.__name__))
+
+def model_spec(simulation, outputs=None):
+    """
+    Writes an existing simulation out as a model, e.g. to turn a model
+    built in Python into a model file.
+
+    @return: the model as an ordered dict
+    """
+    variables = collections.OrderedDict()
+    for key in simulation.schedule():
+        variable = simulation.variables[key]
+        entry = collections.OrderedDict([("name", variable.name), ("units", variable.units)])
+        if isinstance(variable, CalculatedValue):
+            entry["equation"] = variable.equation
+        else:
+            entry["distribution"] = generator_spec(variable.gen)
+        if variable.initial != 0.0:
+            entry["initial"] = variable.initial
+        if variable.comments is not None:
+            entry["comments"] = variable.comments
+        variables[key] = entry
+    spec = collections.OrderedDict()
+    if simulation.periods > 1:
+        spec["periods"] = simulation.periods
+    if outputs is not None:
+        spec["outputs"] = list(outputs)
+    spec["variables"] = variables
+    return spec
+
+def save_model(simulation, outfile, outputs=None):
+    """
+    Saves a simulation as a JSON model file.
+    """
+    f = open(outfile, "w")
+    try:
+        json.dump(model_spec(simulation, outputs), f, indent=2, separators=(",", ": "))
+        f.write("\n")
+    finally:
+        f.close()
+
+class ModelCache(object):
+    """
+    A directory of compiled models, one pickle per model file content.
+    Entries are written under a temporary name and renamed into place, the
+    same as simcache.ResultCache, so several processes can share one.  The
+    pickles are only as trustworthy as the directory they're in.
+    """
+    def __init__(self, directory):
+        object.__init__(self)
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, text, format, vectorized=False, periods=None):
+        """
+        The plan of an optimized model folds constants differently when it
+        is vectorized, and the compiled model records its periods, so both
+        are part of the key.
+
+        @param periods: the periods passed to loads, or None when the model
+                        file's own periods are used
+        """
+        return hashlib.sha1("%s:%s:%s:%s:%s" % (COMPILED_VERSION, format, bool(vectorized), periods,
+                                                text)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def get(self, key):
+        """
+        @return: the compiled model, or None if it isn't in the cache
+        """
+        try:
+            f = open(self.path(key), "rb")
+        except IOError:
+            self.misses = self.misses + 1
+            return None
+        try:
+            try:
+                state = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            # a damaged entry is the same as a missing one
+            self.misses = self.misses + 1
+            return None
+        self.hits = self.hits + 1
+        return state
+
+    def put(self, key, state):
+        path = self.path(key)
+        temp = "%s.%d.tmp" % (path, os.getpid())
+        f = open(temp, "wb")
+        try:
+            cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(temp, path)
@@ -0,0 +1,312 @@
+"""
+Copyright (c) 2010 Patrick Wagstrom
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+# Binary output formats for simulation results.  Each writer is a Sink, so it
+# can be handed to Simulation.stream or to Simulation.write_output after a
+# normal run, and each one writes whole columns at a time.  Importance
+# sampled runs get an extra column, WEIGHT, with the weight of each iteration.
+import os
+import json
+import shutil
+import struct
+import tempfile
+import zipfile
+import numpy
+from stochasticsim import Sink, CsvSink, WEIGHT, output_keys, period_names, period_columns
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+RAW_MAGIC = "TSASIMR1"
+# columns in raw files start on a multiple of this many bytes
+RAW_ALIGNMENT = 64
+
+class NpySink(Sink):
+    """
+    Writes each variable to its own .npy file in a directory.  Any one of
+    them can be opened with numpy.load(path, mmap_mode="r").  In a
+    simulation with more than one period each file holds an iterations x
+    periods array.
+    """
+    def __init__(self, directory, keys=None):
+        """
+        @param keys: the variables to write, defaults to all of them
+        """
+        Sink.__init__(self)
+        self.directory = directory
+        self.keys = keys
+
+    def begin(self, simulation, keys, iterations):
+        if self.keys is None:
+            self.keys = list(keys)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.names = output_keys(simulation, self.keys)
+        self.columns = {}
+        for x in self.names:
+            shape = (iterations,)
+            if simulation.periods > 1 and x != WEIGHT:
+                shape = (iterations, simulation.periods)
+            self.columns[x] = numpy.lib.format.open_memmap(os.path.join(self.directory, x + ".npy"), mode="w+",
+                                                           dtype=numpy.float64, shape=shape, fortran_order=True)
+
+    def write(self, start, stop, columns):
+        for x in self.names:
+            self.columns[x][start:stop] = columns[x]
+
+    def truncate(self, iterations):
+        # the files are in Fortran order, so each period after the first has
+        # to move; copy them into new files the right size
+        for x in self.names:
+            path = os.path.join(self.directory, x + ".npy")
+            old = self.columns[x]
+            new = numpy.lib.format.open_memmap(path + ".tmp", mode="w+", dtype=numpy.float64,
+                                               shape=(iterations,) + old.shape[1:], fortran_order=True)
+            new[:] = old[:iterations]
+            new.flush()
+            os.rename(path + ".tmp", path)
+            self.columns[x] = new
+
+    def finish(self):
+        for x in self.names:
+            self.columns[x].flush()
+        self.columns = None
+
+class NpzSink(NpySink):
+    """
+    Writes the variables to a single uncompressed .npz archive.  The columns
+    are staged as .npy files on disk while the simulation runs, so the run
+    never has to be held in memory.
+    """
+    def __init__(self, outfile, keys=None):
+        NpySink.__init__(self, None, keys)
+        self.outfile = outfile
+
+    def begin(self, simulation, keys, iterations):
+        self.directory = tempfile.mkdtemp(prefix="simoutput")
+        NpySink.begin(self, simulation, keys, iterations)
+
+    def finish(self):
+        NpySink.finish(self)
+        try:
+            archive = zipfile.ZipFile(self.outfile, "w", zipfile.ZIP_STORED, allowZip64=True)
+            for x in self.names:
+                archive.write(os.path.join(self.directory, x + ".npy"), x + ".npy")
+            archive.close()
+        finally:
+            shutil.rmtree(self.directory)
+
+class RawSink(Sink):
+    """
+    Writes a single file holding a small JSON header followed by each
+    variable as a contiguous block of little-endian float64 values.  Use
+    load_raw to memory-map the columns back.
+
+    The file starts with RAW_MAGIC and the length of the header as an
+    unsigned 64-bit little-endian integer.  The header lists the number of
+    iterations and periods, the seed of the run and the name and byte
+    offset of each column.  A column with more than one period holds each
+    period in turn.  The WEIGHT column only ever has one, which its entry
+    in the header gives.
+    """
+    def __init__(self, outfile, keys=None):
+        """
+        @param keys: the variables to write, defaults to all of them
+        """
+        Sink.__init__(self)
+        self.outfile = outfile
+        self.keys = keys
+
+    def begin(self, simulation, keys, iterations):
+        if self.keys is None:
+            self.keys = list(keys)
+        self.names = output_keys(simulation, self.keys)
+        self.periods = simulation.periods
+        self.seed = simulation.seed
+        self.columns = self.create(self.outfile, iterations)
+
+    def create(self, outfile, iterations):
+        """
+        Lays out an empty file for the given number of iterations.
+
+        @return: the columns of the file, mapped for writing
+        """
+        start, size = raw_header(self.names, iterations, self.periods, self.seed)
+        f = open(outfile, "wb")
+        f.write(start)
+        f.truncate(size)
+        f.close()
+        return load_raw(outfile, mode="r+")
+
+    def write(self, start, stop, columns):
+        for x in self.names:
+            self.columns[x][start:stop] = columns[x]
+
+    def truncate(self, iterations):
+        # the header and every column offset depend on the iterations, so
+        # copy the columns into a new file laid out for the shorter run
+        columns = self.create(self.outfile + ".tmp", iterations)
+        for x in self.names:
+            columns[x][:] = self.columns[x][:iterations]
+            columns[x].flush()
+        os.rename(self.outfile + ".tmp", self.outfile)
+        self.columns = columns
+
+    def finish(self):
+        for x in self.names:
+            self.columns[x].flush()
+        self.columns = None
+
+class ParquetSink(Sink):
+    """
+    Writes the variables as a Parquet table, one row group per chunk, with
+    a column per period named as in period_names.  This needs pyarrow to be
+    installed.
+    """
+    def __init__(self, outfile, keys=None):
+        """
+        @param keys: the variables to write, defaults to all of them
+        """
+        Sink.__init__(self)
+        if pyarrow is None:
+            raise Exception("pyarrow is required for Parquet output")
+        self.outfile = outfile
+        self.keys = keys
+
+    def begin(self, simulation, keys, iterations):
+        if self.keys is None:
+            self.keys = list(keys)
+        self.written = output_keys(simulation, self.keys)
+        self.names = period_names(self.written, simulation.periods)
+        schema = pyarrow.schema([pyarrow.field(x, pyarrow.float64()) for x in self.names])
+        self.writer = pyarrow.parquet.ParquetWriter(self.outfile, schema)
+
+    def write(self, start, stop, columns):
+        arrays = [pyarrow.array(numpy.ascontiguousarray(x, dtype=numpy.float64))
+                  for x in period_columns(self.written, columns)]
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, self.names))
+
+    def finish(self):
+        self.writer.close()
+
+def raw_header(keys, iterations, periods=1, seed=None):
+    """
+    Lays out a file in the format RawSink writes.
+
+    @return: the bytes that come before the first column, and the size of
+             the whole file
+    """
+    header = {"iterations": iterations, "periods": periods, "dtype": "<f8", "seed": seed, "columns": []}
+    # the offsets are part of the header, so size it with placeholders first
+    offset = 0
+    for x in keys:
+        header["columns"].append({"name": x, "offset": 2 ** 62})
+        if x == WEIGHT and periods > 1:
+            header["columns"][-1]["periods"] = 1
+    data_start = raw_data_start(len(json.dumps(header)))
+    for x in header["columns"]:
+        x["offset"] = data_start + offset
+        offset = offset + 8 * iterations * x.get("periods", periods)
+    text = json.dumps(header)
+    text = text + " " * (data_start - len(RAW_MAGIC) - 8 - len(text))
+    return RAW_MAGIC + struct.pack("<Q", len(text)) + text, data_start + offset
+
+def raw_bytes(simulation, keys):
+    """
+    @return: the calculated values of the given variables in the format
+             RawSink writes, as a string
+    """
+    keys = output_keys(simulation, keys)
+    start, size = raw_header(keys, simulation.iterations, simulation.periods, simulation.seed)
+    parts = [start]
+    for x in keys:
+        if x == WEIGHT:
+            values = numpy.asarray(simulation.weights(), dtype="<f8")
+        else:
+            values = numpy.asarray(simulation.variables[x].calculated_values, dtype="<f8")
+        parts.append(values.tostring(order="F"))
+    return "".join(parts)
+
+def raw_data_start(header_length):
+    """
+    @return: the offset of the first column for a header of the given length
+    """
+    size = len(RAW_MAGIC) + 8 + header_length
+    return (size + RAW_ALIGNMENT - 1) // RAW_ALIGNMENT * RAW_ALIGNMENT
+
+def read_raw_header(infile):
+    """
+    @return: the JSON header of a file written by RawSink, as a dict
+    """
+    f = open(infile, "rb")
+    try:
+        if f.read(len(RAW_MAGIC)) != RAW_MAGIC:
+            raise Exception("%s is not a raw simulation output file" % (infile))
+        length = struct.unpack("<Q", f.read(8))[0]
+        return json.loads(f.read(length))
+    finally:
+        f.close()
+
+def load_raw(infile, keys=None, mode="r"):
+    """
+    Memory-maps the columns of a file written by RawSink.  Only the pages
+    of the columns that are actually read get loaded.
+
+    @param keys: the variables to map, defaults to all of them
+    @param mode: the numpy.memmap mode, "r" for read-only
+    @return: a dict mapping each variable name to a numpy.memmap
+    """
+    header = read_raw_header(infile)
+    columns = dict((x["name"], x) for x in header["columns"])
+    if keys is None:
+        keys = [x["name"] for x in header["columns"]]
+    missing = [x for x in keys if x not in columns]
+    if missing:
+        raise Exception("Variables not in %s: %s" % (infile, ", ".join(missing)))
+    result = {}
+    for x in keys:
+        shape = (header["iterations"],)
+        periods = columns[x].get("periods", header.get("periods", 1))
+        if periods > 1:
+            shape = (header["iterations"], periods)
+        result[x] = numpy.memmap(infile, dtype=header["dtype"], mode=mode, offset=columns[x]["offset"], shape=shape,
+                                 order="F")
+    return result
+
+def sink_for(outfile, keys=None):
+    """
+    Picks a writer based on the extension of the output file: .npz, .parquet,
+    .raw, a directory name ending in a slash for one .npy per variable, and
+    the CSV format for anything else.
+    """
+    if outfile.endswith("/") or outfile.endswith(os.sep):
+        return NpySink(outfile, keys)
+    extension = os.path.splitext(outfile)[1].lower()
+    if extension == ".npz":
+        return NpzSink(outfile, keys)
+    if extension == ".parquet":
+        return ParquetSink(outfile, keys)
+    if extension == ".raw":
+        return RawSink(outfile, keys)
+    return CsvSink(outfile, keys)
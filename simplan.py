@@ -0,0 +1,438 @@
+"""
+Copyright (c) 2010 Patrick Wagstrom
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+# Whole-model optimization.  The equations of a simulation are rewritten into
+# a single plan of steps: RandomFixed values and numeric literals are folded
+# into constants, subexpressions that appear more than once anywhere in the
+# model are calculated once, and variables that none of the requested outputs
+# need are left out.  The rewrites never reassociate anything, so a plan gives
+# exactly the same values as running the equations one by one.
+#
+# Two kinds of constants are kept apart.  A "const" comes only from numeric
+# literals and is folded with Python arithmetic, the same as the equations do
+# with literals.  A "fixed" value involves a variable, which the equations
+# would have held as a column, so in a vectorized simulation it is folded
+# with numpy float64 arithmetic to give the same infinities and NaNs.
+import math
+import numpy
+import equationparser
+from equationparser import IDENTIFIER_RE, INTEGER_RE
+from stochasticsim import RandomValue, RandomFixed, CalculatedValue, evaluate_compiled, weight_key
+
+# operators whose operands can be swapped without changing the result
+COMMUTATIVE = "+*"
+CONSTANTS = ("const", "fixed")
+# the kinds of node that are read from a column rather than calculated
+INPUTS = ("name", "lag")
+
+class PlanStep(object):
+    """
+    One step of a plan.  The kind is "random" for a value that is sampled,
+    "constant" for one that is the same in every iteration, and "equation"
+    for one calculated from earlier steps.  Steps that aren't variables of
+    the simulation hold shared subexpressions.
+    """
+    def __init__(self, name, kind, stack=None, value=None, variable=None):
+        """
+        @param stack: the postfix stack of an equation step
+        @param value: the value of a constant step
+        @param variable: the simulation variable for a random step
+        """
+        object.__init__(self)
+        self.name = name
+        self.kind = kind
+        self.stack = stack
+        self.value = value
+        self.variable = variable
+        self.function = None
+        self.inputs = []
+        if stack is not None:
+            self.function = equationparser.compileEquation(stack)
+            self.inputs = self.function.variables
+
+    def expression(self):
+        if self.kind == "constant":
+            return repr(self.value)
+        if self.kind == "random":
+            return "<%s>" % (self.variable.__class__.__name__)
+        return infix(self.stack)
+
+    def calc_range(self, start, stop, columns, vectorized=False):
+        if self.kind == "random":
+            return self.variable.calc_range(start, stop, columns)
+        if self.kind == "constant":
+            return numpy.broadcast_to(numpy.asarray(self.value, dtype=numpy.float64), (stop - start,))
+        return evaluate_compiled(self.function, [columns[x] for x in self.inputs], stop - start, vectorized)
+
+class Plan(object):
+    """
+    The optimized form of a simulation.  Expressions are numbered so that
+    equal subtrees share a node, with the operands of + and * put in a fixed
+    order first so a * b and b * a are the same node.  A node is given its
+    own step when it is a whole equation or when more than one place uses
+    it; everything else is inlined into the step that uses it.
+    """
+    def __init__(self, simulation, outputs=None):
+        """
+        @param outputs: the variables that are wanted from a run, defaults
+                        to all of them.  Anything they don't depend on is
+                        dropped.
+        """
+        object.__init__(self)
+        self.simulation = simulation
+        order = simulation.schedule()
+        if outputs is None:
+            outputs = order
+        missing = [x for x in outputs if x not in simulation.variables]
+        if missing:
+            raise Exception("Unknown output variables: " + ", ".join(missing))
+        self.outputs = list(outputs)
+
+        # a value read a period later still has to be calculated
+        graph = simulation.dependencies(lagged=True)
+        needed = set()
+        pending = list(outputs)
+        while pending:
+            key = pending.pop()
+            if key not in needed:
+                needed.add(key)
+                pending.extend(graph[key])
+        self.variables = [key for key in order if key in needed]
+        self.dropped = [key for key in order if key not in needed]
+
+        # each node is ("name", varname), ("lag", token), ("const", value),
+        # ("fixed", value) or an operation (op, operand, ...) where op is a
+        # postfix token
+        self.nodes = []
+        self.numbers = {}
+        self.roots = {}
+        for key in self.variables:
+            variable = simulation.variables[key]
+            if isinstance(variable, CalculatedValue):
+                self.roots[key] = self.build(variable.parsed_equation)
+            elif isinstance(variable, RandomValue) and isinstance(variable.gen, RandomFixed):
+                self.roots[key] = self.constant(float(variable.gen.val), "fixed")
+            else:
+                self.roots[key] = self.number(("name", key))
+
+        self.uses = [0] * len(self.nodes)
+        seen = set()
+        pending = self.roots.values()
+        while pending:
+            node = pending.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+            if is_operation(self.nodes[node]):
+                for x in self.nodes[node][1:]:
+                    self.uses[x] = self.uses[x] + 1
+                    pending.append(x)
+
+        self.names = {}
+        self.emitted = set()
+        self.steps = []
+        self.shared = []
+        for key in self.variables:
+            self.emit_variable(key)
+
+    def number(self, key, node=None):
+        """
+        @return: the number of the node with the given canonical key, adding
+                 node (or the key itself) if it is new
+        """
+        if key not in self.numbers:
+            self.numbers[key] = len(self.nodes)
+            self.nodes.append(node or key)
+        return self.numbers[key]
+
+    def constant(self, value, kind="const"):
+        # keyed on the type and exact text so 2 and 2.0, or 0.0 and -0.0,
+        # stay separate
+        return self.number((kind, type(value), token(value)), (kind, value))
+
+    def build(self, exprstack):
+        """
+        Numbers every subtree of a parsed equation, folding any operator or
+        function whose operands are all constants.
+
+        @return: the number of the root node
+        """
+        stack = []
+        for op in exprstack:
+            arity = equationparser.tokenArity(op)
+            if arity:
+                operands = stack[-arity:]
+                del stack[-arity:]
+                stack.append(self.operation(op, operands))
+            elif op == "PI":
+                stack.append(self.constant(math.pi))
+            elif op == "E":
+                stack.append(self.constant(math.e))
+            elif equationparser.LAG_RE.search(op):
+                stack.append(self.number(("lag", op)))
+            elif IDENTIFIER_RE.search(op):
+                if self.nodes[self.roots[op]][0] in CONSTANTS:
+                    stack.append(self.constant(float(self.nodes[self.roots[op]][1]), "fixed"))
+                else:
+                    stack.append(self.number(("name", op)))
+            elif INTEGER_RE.search(op):
+                stack.append(self.constant(long(op)))
+            else:
+                stack.append(self.constant(float(op)))
+        return stack[0]
+
+    def operation(self, op, operands):
+        kinds = [self.nodes[x][0] for x in operands]
+        if not [x for x in kinds if x not in CONSTANTS]:
+            values = [self.nodes[x][1] for x in operands]
+            if "fixed" in kinds and self.simulation.vectorized:
+                # the variables would have been columns
+                for i in xrange(len(values)):
+                    if kinds[i] == "fixed":
+                        values[i] = numpy.asarray(values[i], dtype=numpy.float64)
+                errors = numpy.seterr(all="ignore")
+                try:
+                    return self.constant(float(equationparser.applyToken(op, values)), "fixed")
+                finally:
+                    numpy.seterr(**errors)
+            try:
+                value = equationparser.applyToken(op, values)
+            except (ArithmeticError, ValueError):
+                value = None
+            # a literal that can't be written out is left for the equation
+            if "fixed" in kinds and isinstance(value, float):
+                return self.constant(value, "fixed")
+            if is_number(value):
+                return self.constant(value)
+        if op in COMMUTATIVE:
+            return self.number((op,) + tuple(sorted(operands)), (op,) + tuple(operands))
+        return self.number((op,) + tuple(operands))
+
+    def emit_variable(self, key):
+        if key in self.emitted:
+            return
+        root = self.roots[key]
+        node = self.nodes[root]
+        if node[0] in CONSTANTS:
+            self.steps.append(PlanStep(key, "constant", value=node[1]))
+        elif node[0] == "name" and node[1] != key:
+            # an equation that is just another variable
+            self.emit_variable(node[1])
+            self.steps.append(PlanStep(key, "equation", [node[1]]))
+        elif node[0] == "name":
+            self.steps.append(PlanStep(key, "random", variable=self.simulation.variables[key]))
+        elif node[0] == "lag":
+            self.steps.append(PlanStep(key, "equation", [node[1]]))
+        elif root in self.names:
+            # the same equation as a variable that is already calculated
+            self.steps.append(PlanStep(key, "equation", [self.names[root]]))
+        else:
+            stack = self.postfix(root, [])
+            self.steps.append(PlanStep(key, "equation", stack))
+        self.emitted.add(key)
+        self.names.setdefault(root, key)
+
+    def shared_name(self):
+        name = "cse%d" % (len(self.shared) + 1)
+        while name in self.simulation.variables:
+            name = name + "_"
+        self.shared.append(name)
+        return name
+
+    def emit_shared(self, node):
+        name = self.shared_name()
+        self.names[node] = name
+        self.steps.append(PlanStep(name, "equation", self.postfix(node, [])))
+
+    def postfix(self, node, stack):
+        """
+        Appends the postfix stack for a node to stack, using the name of any
+        operand that has its own step and emitting that step first if it
+        hasn't been yet.
+        """
+        op = self.nodes[node]
+        for x in op[1:]:
+            self.operand(x, stack)
+        stack.append(op[0])
+        return stack
+
+    def operand(self, node, stack):
+        op = self.nodes[node]
+        if op[0] in CONSTANTS and is_number(op[1]):
+            stack.append(token(op[1]))
+            return
+        if op[0] in CONSTANTS:
+            # infinities and NaNs can't be written as literals, so they get
+            # a constant step of their own
+            if node not in self.names:
+                self.names[node] = self.shared_name()
+                self.steps.append(PlanStep(self.names[node], "constant", value=op[1]))
+            stack.append(self.names[node])
+            return
+        if op[0] == "name":
+            self.emit_variable(op[1])
+            stack.append(op[1])
+            return
+        if op[0] == "lag":
+            stack.append(op[1])
+            return
+        if node not in self.names:
+            owners = [key for key in self.variables if self.roots[key] == node]
+            if owners:
+                self.emit_variable(owners[0])
+            elif self.uses[node] > 1:
+                self.emit_shared(node)
+        if node in self.names:
+            stack.append(self.names[node])
+        else:
+            self.postfix(node, stack)
+
+    def calc_range(self, start, stop, columns=None):
+        """
+        Runs the plan for iterations start through stop - 1.
+
+        @param columns: the values of any lagged references, see
+                        Simulation.calc_periods
+        @return: a dict mapping each variable in the plan to its values, and
+                 each importance sampled value to its likelihood ratios
+        """
+        simulation = self.simulation
+        columns = dict(columns or {})
+        for step in self.steps:
+            if simulation.hooks:
+                simulation.notify("before_node", step.name, start, stop)
+            columns[step.name] = step.calc_range(start, stop, columns, simulation.vectorized)
+            if simulation.hooks:
+                simulation.notify("after_node", step.name, start, stop, columns[step.name])
+        return dict((key, columns[key]) for key in self.variables + [weight_key(x) for x in self.variables]
+                    if key in columns)
+
+    def state(self):
+        """
+        @return: the steps of the plan as plain data that can be pickled,
+                 for restore to rebuild the plan from without optimizing
+                 again
+        """
+        return {"outputs": list(self.outputs),
+                "variables": list(self.variables),
+                "dropped": list(self.dropped),
+                "shared": list(self.shared),
+                "steps": [(x.name, x.kind, x.stack and tuple(x.stack), x.value,
+                           x.variable is not None and x.variable.varname or None)
+                          for x in self.steps]}
+
+    def rebuild(self):
+        """
+        @return: a new Plan for the same outputs, built from the current
+                 definitions of the variables
+        """
+        return Plan(self.simulation, self.outputs)
+
+    def describe(self):
+        """
+        @return: the plan as text, one step per line in the order they run,
+                 followed by the variables that were dropped
+        """
+        width = max([len(x.name) for x in self.steps] + [0])
+        lines = ["%-8s %s = %s" % (x.name in self.shared and "shared" or x.kind, x.name.ljust(width), x.expression())
+                 for x in self.steps]
+        if self.dropped:
+            lines.append("dropped  " + ", ".join(self.dropped))
+        return "\n".join(lines)
+
+def is_operation(node):
+    return node[0] not in INPUTS and node[0] not in CONSTANTS
+
+def is_number(value):
+    return isinstance(value, (int, long, float)) and not (isinstance(value, float) and
+                                                          (math.isinf(value) or math.isnan(value)))
+
+def token(value):
+    """
+    @return: the stack token for a folded constant, which parses back to
+             the same value and type
+    """
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def infix(exprstack):
+    """
+    @return: a postfix stack written out as an ordinary equation
+    """
+    # each entry is the text and whether it needs brackets as an operand
+    stack = []
+    for op in exprstack:
+        if op in equationparser.opn:
+            right = stack.pop()
+            left = stack.pop()
+            text = "%s %s %s" % (bracket(left), op, bracket(right))
+            stack.append((text, True))
+        elif op == equationparser.UNARY_MINUS:
+            stack.append(("-" + bracket(stack.pop()), True))
+        elif equationparser.functionToken(op) is not None:
+            name, arity = equationparser.functionToken(op)
+            operands = [x[0] for x in stack[-arity:]]
+            del stack[-arity:]
+            stack.append(("%s(%s)" % (name, ", ".join(operands)), False))
+        else:
+            stack.append((op, False))
+    return stack[0][0]
+
+def bracket(operand):
+    if operand[1]:
+        return "(%s)" % (operand[0])
+    return operand[0]
+
+def restore(simulation, state):
+    """
+    Rebuilds a plan from Plan.state for a simulation with the same
+    variables and has the simulation use it.  The restored plan can be run
+    and described but doesn't keep the numbered nodes it was built from.
+
+    @return: the Plan
+    """
+    plan = Plan.__new__(Plan)
+    object.__init__(plan)
+    plan.simulation = simulation
+    plan.outputs = list(state["outputs"])
+    plan.variables = list(state["variables"])
+    plan.dropped = list(state["dropped"])
+    plan.shared = list(state["shared"])
+    plan.steps = []
+    for name, kind, stack, value, varname in state["steps"]:
+        variable = varname is not None and simulation.variables[varname] or None
+        plan.steps.append(PlanStep(name, kind, stack and list(stack), value, variable))
+    simulation.plan = plan
+    return plan
+
+def optimize(simulation, outputs=None):
+    """
+    Builds a plan for a simulation and has the simulation use it for its
+    runs until a variable is added.  Simulation.set_equation, set_generator
+    and replace_variable build it again for the changed definitions.
+
+    @param outputs: the variables that are wanted from a run, defaults to
+                    all of them
+    @return: the Plan
+    """
+    simulation.plan = Plan(simulation, outputs)
+    return simulation.plan
@@ -0,0 +1,166 @@
+"""
+Copyright (c) 2010 Patrick Wagstrom
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+# Per-variable profiling of simulation runs.
+#
+# Usage:
+#     profiler = simprofile.Profiler()
+#     sim.hooks.append(profiler)
+#     sim.run()
+#     print profiler.text_report()
+import json
+import timeit
+from stochasticsim import Hook, RandomValue
+
+class NodeProfile(object):
+    """
+    The totals for one variable, or one shared step of an optimized plan,
+    over every time it was calculated.
+    """
+    def __init__(self, kind):
+        object.__init__(self)
+        self.kind = kind
+        self.calls = 0
+        self.seconds = 0.0
+        self.samples = 0
+        self.output_bytes = 0
+
+    def as_dict(self):
+        return {"kind": self.kind,
+                "calls": self.calls,
+                "seconds": self.seconds,
+                "samples": self.samples,
+                "samples_per_sec": self.samples / self.seconds if self.seconds else None,
+                "output_bytes": self.output_bytes}
+
+class Profiler(Hook):
+    """
+    Times every node and chunk of the runs of a simulation.  Whatever time
+    a chunk takes beyond its nodes is counted as the overhead of the
+    scheduler: looking up inputs, bookkeeping and calling hooks.
+
+    Output bytes are the total size of the arrays the nodes return, not the
+    memory they allocate while calculating them.  Constant columns are
+    views of a single value and count as zero.
+
+    In a parallel run each worker profiles its own shard and the profiles
+    are added together, so the seconds are the total over the workers
+    rather than the time the run took.
+    """
+    mergeable = True
+
+    def __init__(self):
+        Hook.__init__(self)
+        self.reset()
+
+    def reset(self):
+        self.nodes = {}
+        self.chunks = 0
+        self.chunk_seconds = 0.0
+        self.overhead_seconds = 0.0
+        self.node_start = None
+        self.chunk_start = None
+        self.chunk_node_seconds = 0.0
+
+    def before_chunk(self, simulation, start, stop):
+        self.chunk_node_seconds = 0.0
+        self.chunk_start = timeit.default_timer()
+
+    def after_chunk(self, simulation, start, stop, columns):
+        elapsed = timeit.default_timer() - self.chunk_start
+        self.chunks = self.chunks + 1
+        self.chunk_seconds = self.chunk_seconds + elapsed
+        self.overhead_seconds = self.overhead_seconds + elapsed - self.chunk_node_seconds
+
+    def before_node(self, simulation, key, start, stop):
+        self.node_start = timeit.default_timer()
+
+    def after_node(self, simulation, key, start, stop, values):
+        elapsed = timeit.default_timer() - self.node_start
+        self.chunk_node_seconds = self.chunk_node_seconds + elapsed
+        if key not in self.nodes:
+            self.nodes[key] = NodeProfile(node_kind(simulation, key))
+        node = self.nodes[key]
+        node.calls = node.calls + 1
+        node.seconds = node.seconds + elapsed
+        node.samples = node.samples + (stop - start)
+        if getattr(values, "strides", None) != (0,):
+            node.output_bytes = node.output_bytes + getattr(values, "nbytes", 0)
+
+    def merge(self, other):
+        self.chunks = self.chunks + other.chunks
+        self.chunk_seconds = self.chunk_seconds + other.chunk_seconds
+        self.overhead_seconds = self.overhead_seconds + other.overhead_seconds
+        for key, val in other.nodes.iteritems():
+            if key not in self.nodes:
+                self.nodes[key] = NodeProfile(val.kind)
+            node = self.nodes[key]
+            node.calls = node.calls + val.calls
+            node.seconds = node.seconds + val.seconds
+            node.samples = node.samples + val.samples
+            node.output_bytes = node.output_bytes + val.output_bytes
+
+    def report(self):
+        """
+        @return: the profile as a dict, with one entry per node
+        """
+        return {"nodes": dict((key, val.as_dict()) for key, val in self.nodes.iteritems()),
+                "chunks": self.chunks,
+                "chunk_seconds": self.chunk_seconds,
+                "node_seconds": sum([x.seconds for x in self.nodes.itervalues()]),
+                "overhead_seconds": self.overhead_seconds}
+
+    def save_report(self, outfile):
+        f = open(outfile, "w")
+        json.dump(self.report(), f, indent=1, sort_keys=True)
+        f.close()
+
+    def text_report(self):
+        """
+        @return: the profile as a text table, slowest node first, followed by
+                 the totals
+        """
+        total = sum([x.seconds for x in self.nodes.itervalues()]) + self.overhead_seconds
+        headings = ["node", "kind", "calls", "seconds", "%", "samples/sec", "output MiB"]
+        rows = [headings]
+        for key, node in sorted(self.nodes.iteritems(), key=lambda x: (-x[1].seconds, x[0])):
+            rate = node.seconds and "%.4g" % (node.samples / node.seconds) or "-"
+            rows.append([key, node.kind, "%d" % node.calls, "%.4f" % node.seconds,
+                         "%.1f" % (100.0 * node.seconds / total if total else 0.0), rate,
+                         "%.1f" % (node.output_bytes / 1024.0 ** 2)])
+        rows.append(["(scheduler)", "overhead", "%d" % self.chunks, "%.4f" % self.overhead_seconds,
+                     "%.1f" % (100.0 * self.overhead_seconds / total if total else 0.0), "-", "-"])
+        widths = [max([len(row[column]) for row in rows]) for column in xrange(len(headings))]
+        return "\n".join(["  ".join([row[0].ljust(widths[0]), row[1].ljust(widths[1])] +
+                                    [y.rjust(w) for y, w in zip(row[2:], widths[2:])])
+                          for row in rows])
+
+def node_kind(simulation, key):
+    """
+    @return: a short description of what a node is, such as
+             "RandomValue(RandomNormal)" or "CalculatedValue"
+    """
+    variable = simulation.variables.get(key)
+    if variable is None:
+        return "shared"
+    if isinstance(variable, RandomValue):
+        return "RandomValue(%s)" % (variable.gen.__class__.__name__)
+    return variable.__class__.__name__
@@ -0,0 +1,412 @@
+"""
+Copyright (c) 2010 Patrick Wagstrom
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+# A long running HTTP service for running models, e.g. for a web frontend.
+# It only listens on the local machine.  The model files in a directory are
+# loaded once, by the service and by each of a pool of worker processes, so
+# a request only pays for its run.  Identical requests with a seed are
+# answered from an in-memory LRU cache.
+#
+# Usage:
+#     $ python simservice.py --models . --port 8321
+#
+#     GET  /models   the models and their variables
+#     GET  /status   the workers and the cache
+#     POST /run      runs a model, with a JSON body such as
+#
+#     {"model": "tsa",                      the name of the model file
+#      "iterations": 100000,
+#      "seed": 1,                           without one every run differs
+#      "outputs": ["net_cost_ait"],         defaults to every variable
+#      "overrides": {"risk_vpi": {"type": "normal", "mean": 3e-08, "stdev": 4e-09},
+#                    "value_human_life": 5000000,
+#                    "flight_distance": {"equation": "250 * 2"}},
+#      "format": "summary"}                 or "columns"
+#
+# A summary is the JSON report of simstats.StatsSink.  Columns are the
+# values of the outputs in the binary format simoutput.RawSink writes.  An
+# override can importance sample a value, e.g. with a "shift" for a normal
+# distribution, and then both are weighted (see stochasticsim.Simulation).
+import os
+import json
+import time
+import random
+import hashlib
+import logging
+import argparse
+import threading
+import collections
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+import simmodel
+import simplan
+import simstats
+import simoutput
+from stochasticsim import RandomValue, CalculatedValue, NUM_SIMULATIONS
+
+DEFAULT_PORT = 8321
+# the most memory the cached responses may take up, in bytes
+RESPONSE_CACHE_SIZE = 256 * 1024 ** 2
+# the most iterations a single request may ask for
+MAX_ITERATIONS = 10 ** 7
+# how long a run may take, in seconds
+RUN_TIMEOUT = 600
+FORMATS = ("summary", "columns")
+REQUEST_KEYS = ("model", "iterations", "seed", "outputs", "overrides", "format")
+
+log = logging.getLogger("simservice")
+
+# the compiled form of each model, loaded in every worker by init_worker
+models = {}
+
+def find_models(directory):
+    """
+    @return: a dict mapping each model name, the file name without its
+             extension, to the path of the model file
+    """
+    paths = {}
+    for x in sorted(os.listdir(directory)):
+        name, extension = os.path.splitext(x)
+        if extension.lower() in simmodel.FORMATS:
+            paths[name] = os.path.join(directory, x)
+    return paths
+
+def load_models(paths, cache=None):
+    """
+    @param cache: a directory for compiled models, see simmodel
+    @return: a dict mapping each model name to its compiled form
+    """
+    loaded = {}
+    for name, path in paths.iteritems():
+        loaded[name] = simmodel.compiled(simmodel.load_model(path, cache=cache))
+    return loaded
+
+def init_worker(paths, cache=None):
+    """
+    Loads the models in a new worker process and runs each one briefly, so
+    the first real request doesn't pay for anything but its own run.
+    """
+    models.update(load_models(paths, cache))
+    for name in models:
+        run_request(check_request({"model": name, "iterations": 100, "seed": 1}, models))
+
+def check_request(request, model_names):
+    """
+    @return: the request with its defaults filled in
+    """
+    if not isinstance(request, dict):
+        raise RequestError("Expected a JSON object")
+    unknown = [x for x in request if x not in REQUEST_KEYS]
+    if unknown:
+        raise RequestError("Unknown settings: " + ", ".join(sorted(unknown)))
+    if request.get("model") not in model_names:
+        raise RequestError("Unknown model %s" % (request.get("model")))
+    request = dict(request)
+    request.setdefault("iterations", NUM_SIMULATIONS)
+    request.setdefault("seed", None)
+    request.setdefault("outputs", None)
+    request.setdefault("overrides", {})
+    request.setdefault("format", "summary")
+    if not simmodel.is_number(request["iterations"]) or request["iterations"] != int(request["iterations"]) or \
+       not 0 < request["iterations"] <= MAX_ITERATIONS:
+        raise RequestError("iterations must be a whole number from 1 to %d" % (MAX_ITERATIONS))
+    request["iterations"] = int(request["iterations"])
+    if request["seed"] is not None and (not isinstance(request["seed"], (int, long)) or
+                                        isinstance(request["seed"], bool)):
+        raise RequestError("seed must be a whole number")
+    if request["outputs"] is not None and (not isinstance(request["outputs"], list) or
+                                           [x for x in request["outputs"] if not isinstance(x, basestring)]):
+        raise RequestError("outputs must be a list of variable names")
+    if not isinstance(request["overrides"], dict):
+        raise RequestError("overrides must be an object")
+    if request["format"] not in FORMATS:
+        raise RequestError("format must be one of " + ", ".join(FORMATS))
+    return request
+
+def build_run(request):
+    """
+    Makes a fresh simulation of the model of a request, with its overrides
+    applied.  Nothing is parsed except equations given as overrides.  The
+    simulation is optimized for the outputs of the request, or else for
+    those of the model file if it has a plan.
+    """
+    simulation = simmodel.from_compiled(models[request["model"]], vectorized=True, seed=request["seed"],
+                                        iterations=request["iterations"])
+    plan = simulation.plan
+    errors = []
+    for key, spec in sorted(request["overrides"].iteritems()):
+        variable = simulation.variables.get(key)
+        if variable is None:
+            errors.append("%s: unknown variable" % (key))
+        elif isinstance(spec, dict) and "equation" in spec:
+            if len(spec) != 1 or not isinstance(spec["equation"], basestring):
+                errors.append("%s: expected just an equation" % (key))
+                continue
+            try:
+                replacement = CalculatedValue(variable.name, variable.units, spec["equation"], variable.comments)
+            except Exception, e:
+                errors.append("%s: %s" % (key, e))
+                continue
+            replacement.initial = variable.initial
+            simulation.add_variable(key, replacement)
+        else:
+            gen = simmodel.build_generator(spec, key, errors)
+            if gen is not None:
+                simulation.add_variable(key, RandomValue(variable.name, variable.units, gen, variable.comments,
+                                                         variable.initial))
+    if errors:
+        raise RequestError("Invalid overrides:\n  " + "\n  ".join(errors))
+    outputs = request["outputs"]
+    try:
+        if outputs is not None:
+            simplan.optimize(simulation, outputs)
+        elif plan is not None and simulation.plan is None:
+            # the overrides dropped the plan of the model file
+            simplan.optimize(simulation, plan.outputs)
+        else:
+            simulation.schedule()
+    except Exception, e:
+        raise RequestError(str(e))
+    return simulation
+
+def run_request(request):
+    """
+    Runs a checked request in a worker.
+
+    @return: the content type and body of the response
+    """
+    simulation = build_run(request)
+    outputs = simulation.active_keys()
+    if request["outputs"] is not None:
+        outputs = request["outputs"]
+    if request["format"] == "columns":
+        simulation.run()
+        return "application/octet-stream", simoutput.raw_bytes(simulation, outputs)
+    stats = simstats.StatsSink(outputs)
+    simulation.stream([stats])
+    return "application/json", json.dumps({"model": request["model"],
+                                           "iterations": simulation.iterations,
+                                           "seed": simulation.seed,
+                                           "summary": stats.report()})
+
+class RequestError(Exception):
+    """
+    A problem with a request, as opposed to with the service.
+    """
+    pass
+
+class ResponseCache(object):
+    """
+    Keeps the most recently used responses up to a total size.  It is
+    shared by the threads of the server.
+    """
+    def __init__(self, max_bytes=RESPONSE_CACHE_SIZE):
+        object.__init__(self)
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            if key not in self.entries:
+                self.misses = self.misses + 1
+                return None
+            self.hits = self.hits + 1
+            # move it to the most recently used end
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return value
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        size = len(value[1])
+        if size > self.max_bytes:
+            return
+        self.lock.acquire()
+        try:
+            if key in self.entries:
+                self.total = self.total - len(self.entries.pop(key)[1])
+            self.entries[key] = value
+            self.total = self.total + size
+            while self.total > self.max_bytes:
+                self.total = self.total - len(self.entries.popitem(last=False)[1][1])
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """
+        @return: the number of entries, their total size and the hit and
+                 miss counts, read together under the lock
+        """
+        self.lock.acquire()
+        try:
+            return {"entries": len(self.entries), "bytes": self.total, "hits": self.hits, "misses": self.misses}
+        finally:
+            self.lock.release()
+
+class SimulationServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Answers each request on its own thread.  The runs themselves go to the
+    pool of worker processes.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, paths, workers=None, cache=None, cache_size=RESPONSE_CACHE_SIZE):
+        """
+        @param paths: a dict mapping model names to model files
+        @param workers: the number of worker processes, defaults to the
+                        number of CPUs
+        @param cache: a directory for compiled models, see simmodel
+        @param cache_size: the most memory cached responses can take up
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, address, RequestHandler)
+        self.paths = paths
+        # the service checks requests against its own copy of the models
+        self.models = load_models(paths, cache)
+        self.digests = dict((name, hashlib.sha1(repr(state)).hexdigest()) for name, state in self.models.iteritems())
+        self.workers = workers or multiprocessing.cpu_count()
+        self.pool = multiprocessing.Pool(self.workers, init_worker, (paths, cache))
+        self.responses = ResponseCache(cache_size)
+        self.started = time.time()
+
+    def run(self, request):
+        """
+        @return: the content type and body of the response to a request,
+                 and whether it came from the cache
+        """
+        request = check_request(request, self.models)
+        if request["seed"] is None:
+            # an explicit seed makes the response repeatable, and cacheable
+            request["seed"] = random.SystemRandom().getrandbits(63)
+            return self.pool.apply_async(run_request, (request,)).get(RUN_TIMEOUT), False
+        key = json.dumps([self.digests[request["model"]], request], sort_keys=True)
+        response = self.responses.get(key)
+        if response is not None:
+            return response, True
+        response = self.pool.apply_async(run_request, (request,)).get(RUN_TIMEOUT)
+        self.responses.put(key, response)
+        return response, False
+
+    def status(self):
+        return {"workers": self.workers,
+                "uptime": time.time() - self.started,
+                "cache": self.responses.stats()}
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        self.pool.terminate()
+        self.pool.join()
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep connections open between requests
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/models":
+            self.reply(200, "application/json", json.dumps(self.describe_models()))
+        elif self.path == "/status":
+            self.reply(200, "application/json", json.dumps(self.server.status()))
+        else:
+            self.reply(404, "application/json", json.dumps({"error": "Not found"}))
+
+    def do_POST(self):
+        if self.path != "/run":
+            self.reply(404, "application/json", json.dumps({"error": "Not found"}))
+            return
+        try:
+            length = int(self.headers.getheader("content-length", 0))
+            request = json.loads(self.rfile.read(length))
+        except ValueError, e:
+            self.reply(400, "application/json", json.dumps({"error": "Unable to read request: %s" % (e)}))
+            return
+        try:
+            (content_type, body), cached = self.server.run(request)
+        except RequestError, e:
+            self.reply(400, "application/json", json.dumps({"error": str(e)}))
+            return
+        except Exception, e:
+            log.exception("Run failed")
+            self.reply(500, "application/json", json.dumps({"error": str(e)}))
+            return
+        self.reply(200, content_type, body, {"X-Cache": cached and "hit" or "miss"})
+
+    def describe_models(self):
+        result = {}
+        for name, state in self.server.models.iteritems():
+            result[name] = {"periods": state["periods"],
+                            "variables": dict((x["varname"], {"name": x["name"],
+                                                               "units": x["units"],
+                                                               "equation": x.get("equation"),
+                                                               "distribution": x.get("distribution")})
+                                              for x in state["variables"])}
+        return result
+
+    def reply(self, code, content_type, body, headers=None):
+        """
+        Sends a response, a piece at a time so large binary columns don't
+        need a second copy in the socket buffers.
+        """
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, val in (headers or {}).iteritems():
+            self.send_header(key, val)
+        self.end_headers()
+        for start in xrange(0, len(body), 1024 ** 2):
+            self.wfile.write(body[start:start + 1024 ** 2])
+
+    def log_message(self, format, *args):
+        log.info("%s %s", self.address_string(), format % args)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve simulation runs over HTTP on this machine.")
+    parser.add_argument("--models", default=".", help="the directory of model files")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, defaults to one per CPU")
+    parser.add_argument("--model-cache", default=None, help="a directory for compiled models")
+    parser.add_argument("--cache-size", type=int, default=RESPONSE_CACHE_SIZE // 1024 ** 2,
+                        help="the most memory cached responses can use, in megabytes")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    paths = find_models(args.models)
+    if not paths:
+        parser.error("no model files in %s" % (args.models))
+    server = SimulationServer(("127.0.0.1", args.port), paths, args.workers, args.model_cache,
+                              args.cache_size * 1024 ** 2)
+    log.info("Serving %s on http://127.0.0.1:%d/ with %d workers", ", ".join(sorted(paths)), args.port,
+             server.workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
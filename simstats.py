@@ -0,0 +1,383 @@
+"""
+Copyright (c) 2010 Patrick Wagstrom
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+# Summary statistics that are accumulated while a simulation runs, so the
+# percentile tables from stats.R can be produced without keeping the samples.
+# Everything here can be merged, so shards and chunks can be summarized
+# separately and combined afterwards.  The results of importance sampled
+# runs are summarized using the weight of each iteration.
+import json
+import math
+import numpy
+from stochasticsim import Sink, WEIGHT, period_names, period_columns
+
+# the percentiles reported by cumHist in stats.R
+REPORT_PERCENTILES = (0.10, 0.25, 0.50, 0.75, 0.90)
+# the k parameter of the quantile sketch; the rank error is roughly 1.7/k
+SKETCH_SIZE = 256
+
+class QuantileSketch(object):
+    """
+    A KLL quantile sketch.  Values are kept in levels of compactors, where
+    a value in level h stands for 2^h of the original values.  A level that
+    grows past its capacity is sorted and every other value is promoted to
+    the next level up, so only about 3k values are kept no matter how many
+    are added.
+
+    Once weighted values are added each retained value carries its own
+    weight.  Compacting then keeps one value of each pair, picked in
+    proportion to their weights, with the weight of both.
+    """
+    def __init__(self, k=SKETCH_SIZE, seed=0):
+        """
+        @param k: the size of the top compactor; larger is more accurate
+        @param seed: seeds the coin flips used when compacting
+        """
+        object.__init__(self)
+        self.k = k
+        self.count = 0
+        self.levels = [numpy.empty(0, dtype=numpy.float64)]
+        # the weights of the retained values, once any are weighted
+        self.weights = None
+        self.rng = numpy.random.RandomState(seed)
+
+    def capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(2, int(math.ceil(self.k * (2.0 / 3.0) ** depth)))
+
+    def update(self, values, weights=None):
+        """
+        @param weights: the weight of each value, or None to count each once
+        """
+        values = numpy.asarray(values, dtype=numpy.float64).ravel()
+        if weights is not None or self.weights is not None:
+            if weights is None:
+                weights = numpy.ones(len(values), dtype=numpy.float64)
+            self.weights = self.item_weights()
+            self.weights[0] = numpy.concatenate((self.weights[0], numpy.asarray(weights, dtype=numpy.float64).ravel()))
+        self.count = self.count + len(values)
+        self.levels[0] = numpy.concatenate((self.levels[0], values))
+        self.compress()
+
+    def merge(self, other):
+        weighted = self.weights is not None or other.weights is not None
+        if weighted:
+            self.weights = self.item_weights()
+        others = other.item_weights()
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(numpy.empty(0, dtype=numpy.float64))
+                if weighted:
+                    self.weights.append(numpy.empty(0, dtype=numpy.float64))
+            self.levels[level] = numpy.concatenate((self.levels[level], items))
+            if weighted:
+                self.weights[level] = numpy.concatenate((self.weights[level], others[level]))
+        self.count = self.count + other.count
+        self.compress()
+
+    def item_weights(self):
+        """
+        @return: the weight of each retained value, a list with an array for
+                 each level
+        """
+        if self.weights is not None:
+            return self.weights
+        return [numpy.repeat(2.0 ** level, len(x)) for level, x in enumerate(self.levels)]
+
+    def compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self.capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(numpy.empty(0, dtype=numpy.float64))
+                    if self.weights is not None:
+                        self.weights.append(numpy.empty(0, dtype=numpy.float64))
+                if self.weights is None:
+                    items = numpy.sort(items)
+                    # with an odd number of values the smallest one stays behind
+                    odd = len(items) % 2
+                    self.levels[level] = items[:odd]
+                    promoted = items[odd + self.rng.randint(2)::2]
+                else:
+                    order = numpy.argsort(items, kind="mergesort")
+                    items = items[order]
+                    weights = self.weights[level][order]
+                    odd = len(items) % 2
+                    self.levels[level] = items[:odd]
+                    self.weights[level] = weights[:odd]
+                    first = weights[odd::2]
+                    pairs = first + weights[odd + 1::2]
+                    keep = self.rng.random_sample(len(pairs)) * pairs < first
+                    promoted = numpy.where(keep, items[odd::2], items[odd + 1::2])
+                    self.weights[level + 1] = numpy.concatenate((self.weights[level + 1], pairs))
+                self.levels[level + 1] = numpy.concatenate((self.levels[level + 1], promoted))
+            level = level + 1
+
+    def weighted_items(self):
+        """
+        @return: the retained values in sorted order and their cumulative weights
+        """
+        items = numpy.concatenate(self.levels)
+        weights = numpy.concatenate(self.item_weights())
+        order = numpy.argsort(items, kind="mergesort")
+        return items[order], numpy.cumsum(weights[order])
+
+    def quantile(self, q):
+        """
+        @param q: a probability between 0 and 1, or a list of them
+        """
+        items, cumulative = self.weighted_items()
+        if len(items) == 0:
+            return numpy.nan * numpy.asarray(q, dtype=numpy.float64)
+        positions = numpy.searchsorted(cumulative, numpy.asarray(q, dtype=numpy.float64) * cumulative[-1])
+        return items[numpy.minimum(positions, len(items) - 1)]
+
+    def cdf(self, x):
+        """
+        @return: the estimated fraction of values less than or equal to x
+        """
+        items, cumulative = self.weighted_items()
+        if len(items) == 0:
+            return numpy.nan * numpy.asarray(x, dtype=numpy.float64)
+        positions = numpy.searchsorted(items, numpy.asarray(x, dtype=numpy.float64), side="right")
+        return numpy.concatenate(([0.0], cumulative))[positions] / cumulative[-1]
+
+class Histogram(object):
+    """
+    Counts values into fixed bins between low and high.  Values outside the
+    range are counted separately so nothing is lost.
+    """
+    def __init__(self, low, high, bins=50):
+        object.__init__(self)
+        self.edges = numpy.linspace(low, high, bins + 1)
+        self.counts = numpy.zeros(bins, dtype=numpy.int64)
+        self.below = 0
+        self.above = 0
+
+    def update(self, values, weights=None):
+        """
+        @param weights: the weight of each value, which makes the counts
+                        sums of weights rather than whole numbers
+        """
+        values = numpy.asarray(values, dtype=numpy.float64)
+        self.counts = self.counts + numpy.histogram(values, self.edges, weights=weights)[0]
+        if weights is None:
+            self.below = self.below + int(numpy.count_nonzero(values < self.edges[0]))
+            self.above = self.above + int(numpy.count_nonzero(values > self.edges[-1]))
+        else:
+            self.below = self.below + float(numpy.sum(weights[values < self.edges[0]]))
+            self.above = self.above + float(numpy.sum(weights[values > self.edges[-1]]))
+
+    def merge(self, other):
+        if not numpy.array_equal(self.edges, other.edges):
+            raise Exception("Cannot merge histograms with different bins")
+        self.counts = self.counts + other.counts
+        self.below = self.below + other.below
+        self.above = self.above + other.above
+
+    def cumulative(self):
+        """
+        @return: the fraction of values at or below the upper edge of each bin
+        """
+        total = self.counts.sum() + self.below + self.above
+        return (self.below + numpy.cumsum(self.counts)) / float(max(total, 1))
+
+class VariableSummary(object):
+    """
+    The running summary of one variable: the count, mean and variance (using
+    Chan's update of Welford's method, a chunk at a time), the minimum and
+    maximum, a quantile sketch and optionally a histogram.
+
+    With weights the mean, variance, quantiles and histogram are weighted,
+    with the weights normalized by their total.  The variance is corrected
+    for bias using the effective number of samples, which is reported too.
+    """
+    def __init__(self, histogram=None, sketch_size=SKETCH_SIZE):
+        """
+        @param histogram: a (low, high, bins) tuple, or None for no histogram
+        """
+        object.__init__(self)
+        self.count = 0
+        self.weighted = False
+        # the total of the weights and of their squares
+        self.weight = 0
+        self.weight2 = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = numpy.inf
+        self.max = -numpy.inf
+        self.sketch = QuantileSketch(sketch_size)
+        self.histogram = None
+        if histogram is not None:
+            self.histogram = Histogram(*histogram)
+
+    def update(self, values, weights=None):
+        """
+        @param weights: the weight of each value, e.g. of each iteration of
+                        an importance sampled run
+        """
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if len(values) == 0:
+            return
+        if weights is None:
+            mean = values.mean()
+            self.combine(len(values), len(values), len(values), mean, float(((values - mean) ** 2).sum()),
+                         values.min(), values.max())
+        else:
+            weights = numpy.asarray(weights, dtype=numpy.float64)
+            total = float(weights.sum())
+            mean = float((weights * values).sum()) / total
+            self.weighted = True
+            self.combine(len(values), total, float((weights * weights).sum()), mean,
+                         float((weights * (values - mean) ** 2).sum()), values.min(), values.max())
+        self.sketch.update(values, weights)
+        if self.histogram is not None:
+            self.histogram.update(values, weights)
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        self.weighted = self.weighted or other.weighted
+        self.combine(other.count, other.weight, other.weight2, other.mean, other.m2, other.min, other.max)
+        self.sketch.merge(other.sketch)
+        if self.histogram is not None:
+            self.histogram.merge(other.histogram)
+
+    def combine(self, count, weight, weight2, mean, m2, low, high):
+        total = self.weight + weight
+        delta = mean - self.mean
+        self.mean = self.mean + delta * weight / float(total)
+        self.m2 = self.m2 + m2 + delta * delta * self.weight * weight / float(total)
+        self.count = self.count + count
+        self.weight = total
+        self.weight2 = self.weight2 + weight2
+        self.min = min(self.min, low)
+        self.max = max(self.max, high)
+
+    def effective_count(self):
+        """
+        @return: the number of unweighted samples that would give about the
+                 same precision, (sum w)^2 / sum w^2
+        """
+        if not self.weight2:
+            return 0.0
+        return self.weight * self.weight / float(self.weight2)
+
+    def variance(self):
+        if self.count < 2:
+            return numpy.nan
+        if self.weighted:
+            effective = self.effective_count()
+            if effective <= 1:
+                return numpy.nan
+            return self.m2 / self.weight * effective / (effective - 1)
+        return self.m2 / (self.count - 1)
+
+    def stdev(self):
+        return math.sqrt(self.variance())
+
+    def quantile(self, q):
+        return self.sketch.quantile(q)
+
+    def as_dict(self, percentiles=REPORT_PERCENTILES):
+        result = {"count": self.count,
+                  "mean": self.mean,
+                  "stdev": self.stdev(),
+                  "min": self.min,
+                  "max": self.max,
+                  "percentiles": dict(("%g" % x, float(y)) for x, y in zip(percentiles, self.quantile(percentiles)))}
+        if self.weighted:
+            result["effective_count"] = self.effective_count()
+        if self.histogram is not None:
+            result["histogram"] = {"edges": self.histogram.edges.tolist(),
+                                   "counts": self.histogram.counts.tolist(),
+                                   "below": self.histogram.below,
+                                   "above": self.histogram.above}
+        return result
+
+class StatsSink(Sink):
+    """
+    Keeps a VariableSummary for each variable it is given.  It can be used
+    with Simulation.stream to get summary tables without storing any raw
+    samples, and with Simulation.run, including parallel runs, where the
+    summaries of each shard are merged.  In a simulation with more than one
+    period each period is summarized on its own, under the names given by
+    period_names, e.g. "x[0]".  The results of importance sampled runs are
+    summarized using the weight of each iteration.
+    """
+    mergeable = True
+
+    def __init__(self, keys=None, histograms=None, sketch_size=SKETCH_SIZE):
+        """
+        @param keys: the variables to summarize, defaults to all of them
+        @param histograms: a dict mapping variable names to (low, high, bins)
+                           for the variables that should get a histogram
+        """
+        Sink.__init__(self)
+        self.keys = keys
+        self.histograms = histograms or {}
+        self.sketch_size = sketch_size
+        self.summaries = {}
+        self.periods = 1
+        self.names = []
+
+    def begin(self, simulation, keys, iterations):
+        if self.keys is None:
+            self.keys = list(keys)
+        self.periods = simulation.periods
+        self.names = period_names(self.keys, self.periods)
+        self.summaries = dict((x, VariableSummary(self.histograms.get(key), self.sketch_size))
+                              for key in self.keys for x in period_names([key], simulation.periods))
+
+    def write(self, start, stop, columns):
+        weights = columns.get(WEIGHT)
+        for x, values in zip(self.names, period_columns(self.keys, columns)):
+            self.summaries[x].update(values, weights)
+
+    def merge(self, other):
+        for x in self.names:
+            self.summaries[x].merge(other.summaries[x])
+
+    def report(self, percentiles=REPORT_PERCENTILES):
+        """
+        @return: a dict mapping each variable name to its summary as a dict
+        """
+        return dict((x, self.summaries[x].as_dict(percentiles)) for x in self.names)
+
+    def save_report(self, outfile, percentiles=REPORT_PERCENTILES):
+        f = open(outfile, "w")
+        json.dump(self.report(percentiles), f, indent=1, sort_keys=True)
+        f.close()
+
+    def text_report(self, percentiles=REPORT_PERCENTILES):
+        """
+        @return: the summaries as a text table, one variable per line
+        """
+        headings = ["variable", "count", "mean", "stdev", "min"] + ["p%g" % (x * 100) for x in percentiles] + ["max"]
+        rows = [headings]
+        for x in period_names(sorted(self.keys), self.periods):
+            summary = self.summaries[x]
+            values = [summary.mean, summary.stdev(), summary.min] + list(summary.quantile(percentiles)) + [summary.max]
+            rows.append([x, "%d" % summary.count] + ["%.6g" % y for y in values])
+        widths = [max([len(row[column]) for row in rows]) for column in xrange(len(headings))]
+        return "\n".join(["  ".join([row[0].ljust(widths[0])] + [y.rjust(w) for y, w in zip(row[1:], widths[1:])])
+                          for row in rows])
@@ -0,0 +1,187 @@
+"""
+Copyright (c) 2010 Patrick Wagstrom
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+# Scrambled Sobol sequences for quasi-Monte Carlo sampling.  Point i of the
+# sequence only depends on i, so any range of iterations can be generated on
+# its own, which keeps chunked and parallel runs identical to serial ones.
+import numpy
+
+BITS = 32
+
+# Primitive polynomials and initial direction numbers for dimensions 2
+# through 21, from Joe and Kuo's new-joe-kuo-6.21201 table.  Each entry is
+# (degree, a, m) where a holds the inner coefficients of the polynomial.
+JOE_KUO = [(1, 0, (1,)),
+           (2, 1, (1, 3)),
+           (3, 1, (1, 3, 1)),
+           (3, 2, (1, 1, 1)),
+           (4, 1, (1, 1, 3, 3)),
+           (4, 4, (1, 3, 5, 13)),
+           (5, 2, (1, 1, 5, 5, 17)),
+           (5, 4, (1, 1, 5, 5, 5)),
+           (5, 7, (1, 1, 7, 11, 19)),
+           (5, 11, (1, 1, 5, 1, 1)),
+           (5, 13, (1, 1, 1, 3, 11)),
+           (5, 14, (1, 3, 5, 5, 31)),
+           (6, 1, (1, 3, 3, 9, 7, 49)),
+           (6, 13, (1, 1, 1, 15, 21, 21)),
+           (6, 16, (1, 3, 1, 13, 27, 49)),
+           (6, 19, (1, 1, 1, 15, 7, 5)),
+           (6, 22, (1, 3, 1, 15, 13, 25)),
+           (6, 25, (1, 1, 5, 5, 19, 61)),
+           (7, 1, (1, 3, 7, 11, 23, 15, 103)),
+           (7, 4, (1, 3, 7, 13, 13, 15, 69))]
+
+# direction numbers are only worked out once per dimension
+_directions = {}
+# primitive polynomials past the end of JOE_KUO, found as they are needed
+_extra_polynomials = []
+
+def polymulmod(x, y, poly, degree):
+    """
+    Multiplies two polynomials over GF(2), held as bit masks, modulo poly.
+    """
+    result = 0
+    while y:
+        if y & 1:
+            result = result ^ x
+        y = y >> 1
+        x = x << 1
+        if x >> degree:
+            x = x ^ poly
+    return result
+
+def polypowmod(x, exponent, poly, degree):
+    result = 1
+    while exponent:
+        if exponent & 1:
+            result = polymulmod(result, x, poly, degree)
+        x = polymulmod(x, x, poly, degree)
+        exponent = exponent >> 1
+    return result
+
+def prime_factors(n):
+    factors = []
+    divisor = 2
+    while divisor * divisor <= n:
+        if n % divisor == 0:
+            factors.append(divisor)
+            while n % divisor == 0:
+                n = n // divisor
+        divisor = divisor + 1
+    if n > 1:
+        factors.append(n)
+    return factors
+
+def is_primitive(degree, a):
+    """
+    Checks whether x^degree + (the bits of a) + 1 is a primitive polynomial,
+    which is when x has order 2^degree - 1 modulo it.
+    """
+    poly = (1 << degree) | (a << 1) | 1
+    order = (1 << degree) - 1
+    if polypowmod(2, order, poly, degree) != 1:
+        return False
+    for factor in prime_factors(order):
+        if polypowmod(2, order // factor, poly, degree) == 1:
+            return False
+    return True
+
+def polynomial(index):
+    """
+    @return: the (degree, a) of the index-th primitive polynomial after the
+             ones used by JOE_KUO, in order of degree and then a
+    """
+    used = set([(x[0], x[1]) for x in JOE_KUO])
+    if _extra_polynomials:
+        degree, a = _extra_polynomials[-1]
+        a = a + 1
+    else:
+        degree, a = JOE_KUO[-1][0], 0
+    while len(_extra_polynomials) <= index:
+        if a >= 1 << (degree - 1):
+            degree = degree + 1
+            a = 0
+        if (degree, a) not in used and is_primitive(degree, a):
+            _extra_polynomials.append((degree, a))
+        a = a + 1
+    return _extra_polynomials[index]
+
+def direction_numbers(dimension):
+    """
+    @param dimension: the zero-based dimension of the sequence
+    @return: a list of BITS direction numbers, most significant bit first
+    """
+    if dimension in _directions:
+        return _directions[dimension]
+
+    if dimension == 0:
+        m = [1] * BITS
+    else:
+        if dimension <= len(JOE_KUO):
+            degree, a, initial = JOE_KUO[dimension - 1]
+        else:
+            # past the table the polynomials are still primitive but the
+            # initial numbers are just odd numbers from a fixed generator
+            degree, a = polynomial(dimension - len(JOE_KUO) - 1)
+            rng = numpy.random.RandomState(dimension)
+            initial = [2 * rng.randint(1 << k) + 1 for k in xrange(degree)]
+        m = list(initial[:BITS])
+        for k in xrange(degree, BITS):
+            value = m[k - degree] ^ (m[k - degree] << degree)
+            for j in xrange(1, degree):
+                if (a >> (degree - 1 - j)) & 1:
+                    value = value ^ (m[k - j] << j)
+            m.append(value)
+    _directions[dimension] = [m[k] << (BITS - 1 - k) for k in xrange(BITS)]
+    return _directions[dimension]
+
+def scramble(directions, rng):
+    """
+    Applies a random linear matrix scramble and a random digital shift.
+    Both keep the low-discrepancy structure of the sequence.
+
+    @param rng: a random.Random used to pick the scramble
+    @return: the scrambled direction numbers and the shift
+    """
+    scrambled = [0] * BITS
+    for row in xrange(BITS):
+        # a lower triangular matrix with ones on the diagonal, with row 0
+        # being the most significant bit
+        mask = (1 << (BITS - 1 - row)) | (rng.getrandbits(row) << (BITS - row) if row else 0)
+        for k in xrange(BITS):
+            if bin(directions[k] & mask).count("1") % 2:
+                scrambled[k] = scrambled[k] | (1 << (BITS - 1 - row))
+    return scrambled, rng.getrandbits(BITS)
+
+def points(directions, shift, start, stop):
+    """
+    @return: points start through stop - 1 of the sequence as floats strictly
+             between 0 and 1
+    """
+    index = numpy.arange(start, stop, dtype=numpy.uint64)
+    gray = index ^ (index >> numpy.uint64(1))
+    values = numpy.zeros(stop - start, dtype=numpy.uint64)
+    for k in xrange(max(stop, 1).bit_length()):
+        bits = (gray >> numpy.uint64(k)) & numpy.uint64(1)
+        values = values ^ (bits * numpy.uint64(directions[k]))
+    values = values ^ numpy.uint64(shift)
+    return (values.astype(numpy.float64) + 0.5) / 2.0 ** BITS
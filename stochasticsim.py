@@ -22,72 +22,1397 @@ THE SOFTWARE.
 import random
 import re
 import equationparser
+import sobol
 import csv
+import bisect
+import collections
+import hashlib
+import multiprocessing
+import struct
+import itertools
+import Queue
+import math
+import logging
+import numpy
 
 # Simulation Constants
 NUM_SIMULATIONS=10000
 SPLIT_CHARACTERS = '[ +-/*\(\)]'
 NUMERIC_RE = r"[0-9]+(\.[0-9]+)?"
+# Random values get a fresh random stream every SEED_BLOCK_SIZE iterations,
+# which is what lets a run be split up without changing its results
+SEED_BLOCK_SIZE = 4096
+# Default number of iterations held in memory at once by Simulation.stream
+CHUNK_SIZE = 16 * SEED_BLOCK_SIZE
+# Ways of drawing the samples of random values.  Everything except plain
+# Monte Carlo maps uniforms through the inverse CDF of the distribution.
+SAMPLING_METHODS = ("montecarlo", "latin", "antithetic", "sobol")
+# With importance sampling the columns of a run also hold the likelihood
+# ratios of each biased random value, under weight_key(name), and their
+# product, the weight of each iteration, under WEIGHT
+WEIGHT = "[weight]"
+
+# progress goes to this logger, at INFO for each run and DEBUG for each
+# variable; tsa.py shows INFO and above
+log = logging.getLogger("stochasticsim")
 
 # Base Classes for Simulation
 class Simulation(object):
-    def __init__(self):
+    def __init__(self, vectorized=False, seed=None, iterations=None, sampling="montecarlo", periods=1):
+        """
+        @param vectorized: evaluate each CalculatedValue a whole column at a
+                           time using numpy rather than one iteration at a time
+        @param seed: the seed for every random stream in the simulation.  If
+                     not given a new one is picked on the first run.
+        @param iterations: the number of iterations in a run, defaults to
+                           NUM_SIMULATIONS
+        @param sampling: one of SAMPLING_METHODS.  "latin" stratifies each
+                         seed block of every random value, "antithetic" pairs
+                         each draw u with 1 - u, and "sobol" uses a scrambled
+                         Sobol sequence with one dimension per random value.
+        @param periods: the number of time periods, such as years, in each
+                        iteration.  With more than one the values of every
+                        variable are an iterations x periods array, random
+                        values are drawn afresh for each period, and
+                        equations can use x[t-1] for the value of x in the
+                        period before.  See calc_periods.
+
+        Runs calculate the variables one at a time unless plan has been set
+        by simplan.optimize, in which case the optimized plan is run.  If
+        cache is set to a simcache.ResultCache, runs without a plan go a
+        cache chunk at a time and load any chunk of a variable that has
+        been calculated before.
+
+        Each Hook in hooks is called before and after every chunk of
+        iterations and every variable in it, see simprofile.Profiler.  In
+        parallel runs the hooks are called in the worker processes, and
+        mergeable hooks are combined afterwards, see Hook.
+
+        Random values with a biased generator, such as a RandomTabular with
+        a bias or a RandomNormal with a shift, are importance sampled.  Each
+        iteration then has a weight, the product of the likelihood ratios of
+        its biased draws, which the sinks are handed in the WEIGHT column
+        and which weights() gives after a run.  Statistics of the results
+        have to be weighted by it, see simstats and weighted_quantile.
+        """
+        if sampling not in SAMPLING_METHODS:
+            raise Exception("Unknown sampling method %s, expected one of %s" % (sampling, ", ".join(SAMPLING_METHODS)))
+        if periods < 1:
+            raise Exception("A simulation needs at least one period")
         self.variables = {}
+        self.vectorized = vectorized
+        self.seed = seed
+        self.sampling = sampling
+        if iterations is None:
+            iterations = NUM_SIMULATIONS
+        self.iterations = iterations
+        self.convergence = None
+        self.periods = periods
+        # the period being calculated
         self.period = 0
         self.iteration = 0
+        self.order = None
+        self.plan = None
+        self.cache = None
+        self.hooks = []
 
     def add_variable(self, varname, variable):
         self.variables[varname] = variable
         variable.simulation = self
+        variable.varname = varname
+        self.order = None
+        self.plan = None
+
+    def dependencies(self, lagged=False):
+        """
+        Builds the dependency graph of the simulation.
+
+        @param lagged: also count the variables read from earlier periods,
+                       which don't need to be calculated first but do need
+                       to be calculated
+        @return: a dict mapping each variable name to the list of variable
+                 names it reads from
+        """
+        graph = {}
+        for key, val in self.variables.iteritems():
+            deps = []
+            for x in getattr(val, "variables", []):
+                if x not in deps:
+                    deps.append(x)
+            if lagged:
+                for token, x, lag in getattr(val, "lags", []):
+                    if x not in deps:
+                        deps.append(x)
+            graph[key] = deps
+        return graph
+
+    def lags(self):
+        """
+        @return: a dict mapping each lagged reference in the equations, such
+                 as "x[t-1]", to the variable and how many periods back
+        """
+        lags = {}
+        for val in self.variables.itervalues():
+            for token, x, lag in getattr(val, "lags", []):
+                lags[token] = (x, lag)
+        return lags
+
+    def schedule(self):
+        """
+        Sorts the variables so that each one comes after everything it
+        depends on.  The order is computed once and reused until another
+        variable is added.
+
+        @return: a list of variable names in evaluation order
+        """
+        if self.order is not None:
+            return self.order
+
+        graph = self.dependencies()
+        undefined = ["%s (%s)" % (key, ", ".join([x for x in deps if x not in graph]))
+                     for key, deps in sorted(self.dependencies(lagged=True).iteritems())
+                     if [x for x in deps if x not in graph]]
+        if undefined:
+            raise Exception("Undefined variables referenced by: " + "; ".join(undefined))
+
+        # Kahn's algorithm, seeded in name order so the result is stable
+        waiting = dict((key, len(deps)) for key, deps in graph.iteritems())
+        dependents = dict((key, []) for key in graph)
+        for key, deps in graph.iteritems():
+            for x in deps:
+                dependents[x].append(key)
+        ready = collections.deque(sorted([key for key, count in waiting.iteritems() if count == 0]))
+        order = []
+        while ready:
+            key = ready.popleft()
+            order.append(key)
+            for x in sorted(dependents[key]):
+                waiting[x] = waiting[x] - 1
+                if waiting[x] == 0:
+                    ready.append(x)
+
+        if len(order) < len(graph):
+            blocked = set(graph) - set(order)
+            # follow unresolved dependencies until a name repeats
+            key = min(blocked)
+            path = []
+            while key not in path:
+                path.append(key)
+                key = min([x for x in graph[key] if x in blocked])
+            cycle = path[path.index(key):] + [key]
+            raise Exception("Circular dependency: %s (unable to calculate: %s)" %
+                            (" -> ".join(cycle), ", ".join(sorted(blocked))))
+
+        self.order = order
+        return self.order
 
     def get_variable(self, variable, iteration=None, period=None):
-        return self.variables[variable].calculated_values[iteration]
+        """
+        @param period: the period to read in a simulation with more than
+                       one, defaults to the one being calculated
+        """
+        values = self.variables[variable].calculated_values
+        if values.ndim == 2:
+            if period is None:
+                period = self.period
+            return values[iteration, period]
+        return values[iteration]
+
+    def downstream(self, changed):
+        """
+        @param changed: a list of variable names
+        @return: the names of those variables and of everything calculated
+                 from them, directly or not, in evaluation order
+        """
+        dependents = dict((key, []) for key in self.variables)
+        for key, deps in self.dependencies(lagged=True).iteritems():
+            for x in deps:
+                if x in dependents:
+                    dependents[x].append(key)
+        affected = set(changed)
+        pending = list(changed)
+        while pending:
+            for x in dependents[pending.pop()]:
+                if x not in affected:
+                    affected.add(x)
+                    pending.append(x)
+        return [key for key in self.schedule() if key in affected]
+
+    def recalculate(self, changed):
+        """
+        Recalculates the given variables of a simulation that has already
+        run, along with everything downstream of them.  Everything else,
+        including the other random values, keeps its stored samples, so the
+        old and new results share common random numbers.  With a plan only
+        the variables it keeps are recalculated; the ones it dropped were
+        never calculated and stay that way.
+
+        @param changed: a list of variable names whose definitions changed
+        @return: the names of the variables that were recalculated
+        """
+        keys = self.active_keys()
+        stale = [key for key in keys if not self.variables[key].calculated and key not in changed]
+        affected = [key for key in self.downstream(changed) if key in keys]
+        stale = [key for key in stale if key not in affected]
+        if stale:
+            raise Exception("Run the simulation before recalculating; not yet calculated: " + ", ".join(sorted(stale)))
+        self.choose_seed()
+        for key in affected:
+            self.variables[key].calculated = False
+        if self.periods > 1 or self.lags():
+            # every period has to be gone through in turn
+            known = dict((key, self.variables[key].calculated_values) for key in keys if key not in affected)
+            known.update((weight_key(key), self.variables[key].likelihood) for key in keys
+                         if key not in affected and getattr(self.variables[key], "likelihood", None) is not None)
+            self.store_columns(self.calc_periods(0, self.iterations, known))
+            return affected
+        for key in affected:
+            log.debug("Recalculating: %s", key)
+            if self.hooks:
+                self.notify("before_node", key, 0, self.iterations)
+            self.variables[key].calc()
+            if self.hooks:
+                self.notify("after_node", key, 0, self.iterations, self.variables[key].calculated_values)
+        return affected
+
+    def replace_variable(self, varname, variable):
+        """
+        Swaps in a new definition for an existing variable and recalculates
+        only what depends on it.  If the new definition would leave the model
+        with a cycle or an undefined name, or can't be calculated, the old
+        one is put back and the simulation is left as it was.
+
+        @return: the names of the variables that were recalculated
+        """
+        old = self.variables[varname]
+        def change():
+            self.add_variable(varname, variable)
+        def undo():
+            self.add_variable(varname, old)
+        return self.change_variable(varname, change, undo)
+
+    def set_generator(self, varname, gen):
+        """
+        Gives a RandomValue a new RandomNumber and recalculates only what
+        depends on it.  The value is redrawn from the same random streams.
+        If the recalculation fails the simulation is left as it was.
+
+        @return: the names of the variables that were recalculated
+        """
+        variable = self.variables[varname]
+        old = variable.gen
+        def change():
+            variable.gen = gen
+        def undo():
+            variable.gen = old
+        return self.change_variable(varname, change, undo)
+
+    def set_equation(self, varname, equation):
+        """
+        Gives a CalculatedValue a new equation and recalculates only what
+        depends on it.  If the new equation doesn't parse, would leave the
+        model with a cycle or an undefined name, or can't be calculated, the
+        variable and the simulation are left as they were.
+
+        @return: the names of the variables that were recalculated
+        """
+        variable = self.variables[varname]
+        old = (variable.equation, tuple(variable.parsed_equation))
+        def change():
+            variable.set_equation(equation)
+        def undo():
+            variable.set_equation(old[0], old[1])
+        return self.change_variable(varname, change, undo)
+
+    def change_variable(self, varname, change, undo):
+        """
+        Changes the definition of a variable, then schedules the simulation,
+        builds its plan again and recalculates what depends on the variable.
+        If any of that fails the change is undone and the seed, order, plan
+        and results are put back.
 
-    def run(self):
+        @param change: makes the change, leaving the variable untouched if
+                       it raises
+        @param undo: reverses the change
+        @return: the names of the variables that were recalculated
+        """
+        self.check_changeable(varname)
+        saved = (self.seed, self.order, self.plan)
+        results = dict((key, (val.calculated, val.calculated_values, getattr(val, "likelihood", None)))
+                       for key, val in self.variables.iteritems())
+        change()
+        try:
+            self.order = None
+            self.plan = None
+            self.schedule()
+            return self.recalculate([varname] + self.replan(saved[2]))
+        except Exception:
+            undo()
+            self.seed, self.order, self.plan = saved
+            for key, (calculated, values, likelihood) in results.iteritems():
+                variable = self.variables[key]
+                variable.calculated = calculated
+                variable.calculated_values = values
+                if isinstance(variable, RandomValue):
+                    variable.likelihood = likelihood
+            raise
+
+    def check_changeable(self, varname):
+        """
+        Raises an exception if a variable can't be changed and recalculated
+        in place because the plan pruned it, so it was never calculated.
+        """
+        if self.plan is not None and varname in self.plan.dropped:
+            raise Exception("%s was dropped by the optimized plan and has no values to recalculate; "
+                            "set plan to None and run the simulation before changing it" % (varname))
+
+    def replan(self, plan):
+        """
+        Optimizes the simulation again for the outputs of the plan it had
+        before a variable changed, since the old plan's steps were built
+        from the old definitions.
+
+        @return: the variables the new plan keeps that the old one dropped,
+                 which have never been calculated
+        """
+        if plan is None:
+            return []
+        self.plan = plan.rebuild()
+        return [key for key in self.plan.variables if key in plan.dropped]
+
+    def choose_seed(self, seed=None):
+        """
+        Sets the seed for a run.  Without an explicit seed the simulation
+        keeps its current one, or picks a new one if it has none yet.  With
+        a cache the new one is the seed the cache remembers, so an
+        interrupted run picks up where it left off.
+        """
+        if seed is not None:
+            self.seed = seed
+        elif self.seed is None and self.cache is not None:
+            self.seed = self.cache.default_seed()
+        elif self.seed is None:
+            self.seed = random.SystemRandom().getrandbits(64)
+
+    def node_hashes(self):
+        """
+        Hashes the definition of every variable together with the hashes of
+        everything it depends on, so a hash changes whenever anything that
+        goes into the values of the variable does.  The seed isn't part of
+        the hash.
+
+        @return: a dict mapping each variable name to a hex digest
+        """
+        graph = self.dependencies()
+        random_keys = sorted([key for key, val in self.variables.iteritems()
+                              if isinstance(val, RandomValue) and not isinstance(val.gen, RandomFixed)])
+        model = None
+        if self.lags():
+            # a lag can point anywhere, even at the variable itself, so any
+            # change to the model changes every hash
+            model = hashlib.md5("\n".join(["%s=%s" % (key, self.variables[key].definition())
+                                           for key in sorted(self.variables)])).hexdigest()
+        hashes = {}
+        for key in self.schedule():
+            variable = self.variables[key]
+            parts = [key, variable.definition(), self.sampling, str(SEED_BLOCK_SIZE)]
+            if isinstance(variable, CalculatedValue):
+                parts.append(str(self.vectorized))
+            elif self.sampling == "sobol":
+                # the sobol dimension of a value depends on the other values
+                parts.append(",".join(random_keys))
+            if self.periods > 1:
+                parts.append("periods=%d" % (self.periods))
+            if model is not None:
+                parts.append("model=%s" % (model))
+            parts.extend(["%s=%s" % (x, hashes[x]) for x in sorted(graph[key])])
+            hashes[key] = hashlib.md5("\n".join(parts)).hexdigest()
+        return hashes
+
+    def seed_stream(self, varname, block):
+        """
+        Seeds both the random module and numpy for one block of iterations of
+        one variable in the current period.  The seed only depends on the
+        simulation seed, the variable, the block and the period, never on
+        what else has been drawn.
+        """
+        self.choose_seed()
+        if self.period:
+            digest = hashlib.md5("%s:%s:%d:%d" % (self.seed, varname, block, self.period)).digest()
+        else:
+            digest = hashlib.md5("%s:%s:%d" % (self.seed, varname, block)).digest()
+        random.seed(long(digest.encode("hex"), 16))
+        numpy.random.seed(struct.unpack("<4I", digest))
+
+    def block_uniforms(self, count):
+        """
+        Makes the uniforms for the first count iterations of a seed block
+        under latin or antithetic sampling.  The whole block is always laid
+        out so the values don't depend on how much of it is used.  Call
+        seed_stream first.
+        """
+        if self.sampling == "latin":
+            uniforms = (numpy.random.permutation(SEED_BLOCK_SIZE) +
+                        numpy.random.random_sample(SEED_BLOCK_SIZE)) / SEED_BLOCK_SIZE
+        else:
+            half = numpy.random.random_sample((SEED_BLOCK_SIZE + 1) // 2)
+            uniforms = numpy.empty(2 * len(half), dtype=numpy.float64)
+            uniforms[0::2] = half
+            uniforms[1::2] = 1.0 - half
+        return uniforms[:count]
+
+    def sobol_uniforms(self, varname, start, stop):
+        """
+        Makes the uniforms for iterations start through stop - 1 of a random
+        value under sobol sampling.  Each non-constant random value gets its
+        own dimension, in name order, scrambled using the simulation seed.
+        Each later period takes the next set of dimensions.
+        """
+        self.choose_seed()
+        keys = sorted([key for key, val in self.variables.iteritems()
+                       if isinstance(val, RandomValue) and not isinstance(val.gen, RandomFixed)])
+        dimension = keys.index(varname) + self.period * len(keys)
+        digest = hashlib.md5("%s:%s:sobol" % (self.seed, varname)).hexdigest()
+        if self.period:
+            digest = hashlib.md5("%s:%s:%d:sobol" % (self.seed, varname, self.period)).hexdigest()
+        directions, shift = sobol.scramble(sobol.direction_numbers(dimension), random.Random(long(digest, 16)))
+        return sobol.points(directions, shift, start, stop)
+
+    def run(self, workers=1, seed=None, sinks=(), iterations=None):
+        """
+        @param workers: the number of processes to split the iterations over
+        @param seed: overrides the seed the simulation was created with
+        @param sinks: Sink objects that are handed the results of the run
+        @param iterations: overrides the number of iterations for this run
+        """
         # rest of this is simulation stuff, you shouldn't need to modify much here
-        random.seed()
-
-        # need to insert some sort of reachability check on the elements here
-        while False in [x.calculated for x in self.variables.itervalues()]:
-            calculated_variables = []
-            for key, val in self.variables.iteritems():
-                if val.calculated == False:
-                    print "Calculating: %s" % (key)
-                    calculated_variables.append(val.calc())
-            if not(calculated_variables) or True not in calculated_variables:
-                raise Exception("Stalemate!")
-
-    def save_output(self, outfile):
-        print "Dumping data to %s" % (outfile)
-        f = open(outfile, "wb")
-        csvwriter = csv.writer(f, delimiter=" ")
-        rvkeys = self.variables.keys()
-        csvwriter.writerow(self.variables.keys())
-        for x in xrange(NUM_SIMULATIONS):
-            thisrow = [self.variables[y].calculated_values[x] for y in rvkeys]
-            csvwriter.writerow(thisrow)
-        f.close()
+        order = self.active_keys()
+        self.choose_seed(seed)
+        if iterations is not None:
+            self.iterations = iterations
+
+        if workers > 1:
+            self.run_parallel(order, workers, sinks)
+            return
+
+        if self.plan is not None:
+            log.info("Calculating %d iterations: %d steps of the optimized plan", self.iterations,
+                     len(self.plan.steps))
+        elif self.cache is not None:
+            log.info("Calculating %d iterations using the cache in %s", self.iterations, self.cache.directory)
+        else:
+            log.info("Calculating %d iterations of %d variables", self.iterations, len(order))
+        self.store_columns(self.calc_range(0, self.iterations))
+        for sink in sinks:
+            self.write_output(sink)
+
+    def run_parallel(self, order, workers, sinks=()):
+        """
+        Splits the iterations into one shard per worker process.  Each worker
+        calculates the whole model for its shard and writes the results
+        straight into shared memory, so only an exit code comes back.  Shards
+        are made of whole seed blocks, so the results are the same for any
+        number of workers.
+
+        Mergeable sinks are fed by the workers and the copy from each shard
+        is sent back and merged in shard order, as are the copies of any
+        mergeable hooks.  Other sinks are fed the complete columns once the
+        workers are done.
+        """
+        blocks = (self.iterations + SEED_BLOCK_SIZE - 1) // SEED_BLOCK_SIZE
+        workers = max(1, min(workers, blocks))
+        bounds = [min(self.iterations, (blocks * x // workers) * SEED_BLOCK_SIZE) for x in xrange(workers + 1)]
+        keys = order + [weight_key(x) for x in self.importance_keys()]
+        shared = dict((key, multiprocessing.RawArray('d', self.iterations * self.periods)) for key in keys)
+
+        mergeable = [x for x in sinks if x.mergeable]
+        for sink in mergeable:
+            sink.begin(self, order, self.iterations)
+        results = multiprocessing.Queue()
+
+        log.info("Calculating %d iterations on %d workers", self.iterations, workers)
+        processes = [multiprocessing.Process(target=self.run_shard,
+                                             args=(keys, shared, bounds[x], bounds[x + 1], mergeable, x, results))
+                     for x in xrange(workers)]
+        for process in processes:
+            process.start()
+        hooks = [x for x in self.hooks if x.mergeable]
+        shard_sinks = {}
+        shard_hooks = {}
+        while (mergeable or hooks) and len(shard_sinks) < workers:
+            try:
+                shard, copies, hook_copies = results.get(timeout=1)
+                shard_sinks[shard] = copies
+                shard_hooks[shard] = hook_copies
+            except Queue.Empty:
+                if [x for x in processes if x.exitcode not in (None, 0)]:
+                    break
+        for process in processes:
+            process.join()
+        failed = ["%d-%d" % (bounds[x], bounds[x + 1] - 1) for x, process in enumerate(processes) if process.exitcode != 0]
+        if failed:
+            raise Exception("Simulation worker failed on iterations " + ", ".join(failed))
+
+        self.store_columns(dict((key, self.shared_values(shared[key])) for key in keys))
+
+        for shard in xrange(len(shard_sinks)):
+            for sink, copy in zip(mergeable, shard_sinks[shard]):
+                sink.merge(copy)
+            for hook, copy in zip(hooks, shard_hooks[shard]):
+                hook.merge(copy)
+        for sink in mergeable:
+            sink.finish()
+        for sink in sinks:
+            if not sink.mergeable:
+                self.write_output(sink)
+
+    def run_shard(self, order, shared, start, stop, sinks=(), shard=0, results=None):
+        """
+        Calculates every variable for iterations start through stop - 1 and
+        copies the results, along with any likelihood ratios, into the
+        shared arrays.  Any sinks are fed the shard and then sent back
+        through the results queue, along with the mergeable hooks.
+        """
+        hooks = [x for x in self.hooks if x.mergeable]
+        for hook in hooks:
+            # this process's copy, so only the shard is sent back
+            hook.reset()
+        columns = self.calc_range(start, stop)
+        for key in order:
+            self.shared_values(shared[key])[start:stop] = columns[key]
+        if sinks:
+            for first in xrange(start, stop, CHUNK_SIZE):
+                last = min(stop, first + CHUNK_SIZE)
+                chunk = dict((key, val[first - start:last - start]) for key, val in columns.iteritems())
+                for sink in sinks:
+                    sink.write(first, last, chunk)
+        if sinks or hooks:
+            results.put((shard, sinks, hooks))
+
+    def shared_values(self, array):
+        """
+        @return: a numpy view of the shared memory of a parallel run that
+                 holds one variable
+        """
+        values = numpy.frombuffer(array, dtype=numpy.float64)
+        if self.periods > 1:
+            return values.reshape((self.iterations, self.periods), order="F")
+        return values
+
+    def run_adaptive(self, targets, batch_size=CHUNK_SIZE, max_iterations=100 * CHUNK_SIZE, min_batches=10,
+                     seed=None, sinks=()):
+        """
+        Runs the simulation in batches until every target has converged or
+        max_iterations is reached.  Convergence is judged with the batch
+        means method: the statistic of each target is computed for each
+        batch, and the confidence interval comes from the spread of those
+        batch values.  The results are the same as a normal run of the same
+        number of iterations with the same seed.
+
+        Afterwards self.iterations is the number of iterations used and
+        self.convergence holds a report of the run, which is also returned.
+
+        @param targets: a list of ConvergenceTarget objects
+        @param batch_size: the number of iterations per batch
+        @param max_iterations: stop after this many iterations even if the
+                               targets haven't converged
+        @param min_batches: the fewest batches to run before checking, at
+                            least 2 so the batches have a spread
+        @param sinks: Sink objects that are handed each batch.  If the run
+                      converges early they are truncated to the iterations
+                      used before they finish.
+        """
+        if min_batches < 2:
+            raise Exception("min_batches must be at least 2")
+        order = self.active_keys()
+        self.choose_seed(seed)
+        missing = [x.variable for x in targets if x.variable not in order]
+        if missing:
+            raise Exception("Unknown target variables: " + ", ".join(missing))
+
+        for target in targets:
+            target.reset()
+        for sink in sinks:
+            sink.begin(self, order, max_iterations)
+        keys = order + [weight_key(x) for x in self.importance_keys()]
+        batches = dict((key, []) for key in keys)
+        start = 0
+        while start < max_iterations:
+            stop = min(max_iterations, start + batch_size)
+            columns = self.calc_range(start, stop)
+            for key in keys:
+                batches[key].append(columns[key])
+            for sink in sinks:
+                sink.write(start, stop, columns)
+            for target in targets:
+                target.add_batch(columns[target.variable], columns.get(WEIGHT))
+            start = stop
+            if len(batches[order[0]]) >= min_batches and False not in [x.converged() for x in targets]:
+                break
+        for sink in sinks:
+            if start < max_iterations:
+                sink.truncate(start)
+            sink.finish()
+
+        self.iterations = start
+        self.store_columns(dict((key, numpy.concatenate(batches[key])) for key in keys))
+        self.convergence = {"iterations": self.iterations,
+                            "batches": len(batches[order[0]]),
+                            "converged": False not in [x.converged() for x in targets],
+                            "targets": [x.report() for x in targets]}
+        log.info("Ran %d iterations (%s)", self.iterations,
+                 self.convergence["converged"] and "converged" or "did not converge")
+        return self.convergence
+
+    def stream(self, sinks, iterations=None, chunk_size=CHUNK_SIZE, seed=None):
+        """
+        Runs the simulation a chunk of iterations at a time, handing each
+        finished chunk to the sinks and then discarding it, so memory use
+        depends on the chunk size rather than the number of iterations.
+        The results are the same as run() with the same seed.  The
+        calculated_values of the variables are left untouched.
+
+        @param sinks: a list of Sink objects to receive the chunks
+        @param iterations: the total number of iterations to run, defaults
+                           to the iterations of the simulation
+        @param chunk_size: the number of iterations per chunk
+        """
+        order = self.active_keys()
+        self.choose_seed(seed)
+        if iterations is None:
+            iterations = self.iterations
+
+        for sink in sinks:
+            sink.begin(self, order, iterations)
+        for start in xrange(0, iterations, chunk_size):
+            stop = min(iterations, start + chunk_size)
+            columns = self.calc_range(start, stop)
+            for sink in sinks:
+                sink.write(start, stop, columns)
+        for sink in sinks:
+            sink.finish()
+
+    def active_keys(self):
+        """
+        @return: the names of the variables a run calculates, in evaluation
+                 order.  With a plan that is only what its outputs need.
+        """
+        if self.plan is not None:
+            return self.plan.variables
+        return self.schedule()
+
+    def importance_keys(self):
+        """
+        @return: the names of the random values a run calculates whose
+                 generators are biased for importance sampling
+        """
+        return [key for key in self.active_keys()
+                if isinstance(self.variables[key], RandomValue) and self.variables[key].gen.biased()]
+
+    def weights(self):
+        """
+        @return: the weight of each iteration of the last run, or None if
+                 nothing was importance sampled
+        """
+        return iteration_weights([self.variables[key].likelihood for key in sorted(self.variables)
+                                  if getattr(self.variables[key], "likelihood", None) is not None])
+
+    def calc_range(self, start, stop):
+        """
+        Calculates iterations start through stop - 1 of every variable a run
+        calculates, without storing them in the variables.
+
+        @return: a dict mapping each variable name to its values.  With
+                 importance sampling it also has the likelihood ratios of
+                 each biased random value and the weight of each iteration.
+        """
+        if self.cache is not None and self.plan is None:
+            columns = self.cached_range(start, stop)
+        elif self.periods > 1 or self.lags():
+            columns = self.calc_periods(start, stop)
+        else:
+            if self.hooks:
+                self.notify("before_chunk", start, stop)
+            if self.plan is not None:
+                columns = self.plan.calc_range(start, stop)
+            else:
+                columns = {}
+                for key in self.schedule():
+                    columns[key] = self.calc_node(key, start, stop, columns)
+            if self.hooks:
+                self.notify("after_chunk", start, stop, columns)
+        weighted = sorted([key for key in self.importance_keys() if weight_key(key) in columns])
+        if weighted:
+            columns[WEIGHT] = iteration_weights([columns[weight_key(key)] for key in weighted])
+        return columns
+
+    def calc_periods(self, start, stop, known=None):
+        """
+        Calculates iterations start through stop - 1 of every period.  The
+        periods go in order, and within each one every variable is
+        calculated for all of the iterations at once, so a lagged reference
+        such as x[t-1] is just a column of the period before.  Lags from
+        before the first period give the initial value of the variable.
+
+        @param known: a dict of variables whose values are already known,
+                      which are used rather than calculated, along with the
+                      likelihood ratios of any that are importance sampled
+        @return: a dict mapping each variable name to its values, which are
+                 a (stop - start) x periods array if there is more than one
+                 period
+        """
+        known = known or {}
+        count = stop - start
+        keys = self.active_keys()
+        lags = self.lags()
+        weighted = [weight_key(key) for key in self.importance_keys() if key not in known]
+        results = dict((key, numpy.empty((count, self.periods), dtype=numpy.float64, order="F"))
+                       for key in keys + weighted if key not in known)
+        for key, val in known.iteritems():
+            results[key] = numpy.asarray(val, dtype=numpy.float64).reshape((count, self.periods), order="F")
+        if self.hooks:
+            self.notify("before_chunk", start, stop)
+        try:
+            for period in xrange(self.periods):
+                self.period = period
+                columns = {}
+                for token, (key, lag) in lags.iteritems():
+                    if period >= lag:
+                        columns[token] = results[key][:, period - lag]
+                    else:
+                        columns[token] = numpy.broadcast_to(numpy.float64(self.variables[key].initial), (count,))
+                if self.plan is not None and not known:
+                    values = self.plan.calc_range(start, stop, columns)
+                else:
+                    for key in keys:
+                        if key in known:
+                            columns[key] = results[key][:, period]
+                        else:
+                            columns[key] = self.calc_node(key, start, stop, columns)
+                    values = columns
+                for key in keys + weighted:
+                    if key not in known:
+                        results[key][:, period] = values[key]
+        finally:
+            self.period = 0
+        if self.periods == 1:
+            results = dict((key, val[:, 0]) for key, val in results.iteritems())
+        if self.hooks:
+            self.notify("after_chunk", start, stop, results)
+        return results
+
+    def calc_node(self, key, start, stop, columns):
+        """
+        Calculates iterations start through stop - 1 of one variable, or of
+        one step of the plan, calling the hooks around it.
+        """
+        log.debug("Calculating: %s", key)
+        if not self.hooks:
+            return self.variables[key].calc_range(start, stop, columns)
+        self.notify("before_node", key, start, stop)
+        values = self.variables[key].calc_range(start, stop, columns)
+        self.notify("after_node", key, start, stop, values)
+        return values
+
+    def notify(self, event, *args):
+        """
+        Calls the given method of every hook with the simulation and args.
+        """
+        for hook in self.hooks:
+            getattr(hook, event)(self, *args)
+
+    def cached_range(self, start, stop):
+        """
+        Same as calc_range, but split at multiples of the cache chunk size.
+        Each chunk of each variable is loaded from the cache if it is there
+        and saved to it once calculated, so the finished chunks of a run
+        that is interrupted don't need to be calculated again.
+        """
+        order = self.schedule()
+        hashes = self.node_hashes()
+        # the likelihood ratios of importance sampled values are cached
+        # alongside their values
+        for key in self.importance_keys():
+            hashes[weight_key(key)] = hashlib.md5(hashes[key] + WEIGHT).hexdigest()
+        keys = [key for key in order + [weight_key(x) for x in order] if key in hashes]
+        size = self.cache.chunk_size
+        bounds = [start] + range((start // size + 1) * size, stop, size) + [stop]
+        parts = dict((key, []) for key in keys)
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            if self.periods > 1 or self.lags():
+                # a chunk goes through every period at once, and only the
+                # variables that aren't in the cache are calculated
+                known = {}
+                for key in order:
+                    values = self.cached_values(hashes, key, first, last)
+                    if values is not None:
+                        known.update(values)
+                columns = self.calc_periods(first, last, known)
+                for key in keys:
+                    if key not in known:
+                        self.cache.put(hashes[key], self.seed, first, last, columns[key])
+                    parts[key].append(columns[key])
+                continue
+            if self.hooks:
+                self.notify("before_chunk", first, last)
+            columns = {}
+            for key in order:
+                values = self.cached_values(hashes, key, first, last)
+                if values is None:
+                    columns[key] = self.calc_node(key, first, last, columns)
+                    self.cache.put(hashes[key], self.seed, first, last, columns[key])
+                    if weight_key(key) in hashes:
+                        self.cache.put(hashes[weight_key(key)], self.seed, first, last, columns[weight_key(key)])
+                else:
+                    columns.update(values)
+            for key in keys:
+                parts[key].append(columns[key])
+            if self.hooks:
+                self.notify("after_chunk", first, last, columns)
+        if len(bounds) == 2:
+            return columns
+        return dict((key, numpy.asfortranarray(numpy.concatenate(val))) for key, val in parts.iteritems())
+
+    def cached_values(self, hashes, key, start, stop):
+        """
+        @return: a dict of the cached values of a variable for iterations
+                 start through stop - 1, along with its likelihood ratios
+                 if it is importance sampled, or None if any of them aren't
+                 in the cache
+        """
+        result = {}
+        for x in (key, weight_key(key)):
+            if x in hashes:
+                result[x] = self.cache.get(hashes[x], self.seed, start, stop)
+                if result[x] is None:
+                    return None
+        return result
+
+    def store_columns(self, columns):
+        """
+        Makes the given columns the results of the variables.  Variables
+        that aren't in columns are marked as not calculated.
+        """
+        for key, val in self.variables.iteritems():
+            if key in columns:
+                val.calculated_values = columns[key]
+                val.calculated = True
+            else:
+                val.calculated_values = numpy.empty(0, dtype=numpy.float64)
+                val.calculated = False
+            if isinstance(val, RandomValue):
+                val.likelihood = columns.get(weight_key(key))
+
+    def write_output(self, sink):
+        """
+        Hands the results of a completed run to a sink, in chunks of
+        CHUNK_SIZE iterations.
+        """
+        keys = [key for key, val in self.variables.iteritems() if val.calculated]
+        weights = self.weights()
+        sink.begin(self, keys, self.iterations)
+        for start in xrange(0, self.iterations, CHUNK_SIZE):
+            stop = min(self.iterations, start + CHUNK_SIZE)
+            columns = dict((key, self.variables[key].calculated_values[start:stop]) for key in keys)
+            if weights is not None:
+                columns[WEIGHT] = weights[start:stop]
+            sink.write(start, stop, columns)
+        sink.finish()
+
+    def save_output(self, outfile, keys=None):
+        """
+        @param keys: the variables to save, defaults to all of them
+        """
+        log.info("Dumping data to %s", outfile)
+        self.write_output(CsvSink(outfile, keys))
+
+class Hook(object):
+    """
+    Base class for instrumentation hooks.  Add one to Simulation.hooks and
+    its methods are called as the simulation runs; each one is handed the
+    simulation first.  The key of a node is a variable name, or the name
+    of a shared step of an optimized plan.
+
+    In a parallel run the hooks are called in the worker processes.  Hooks
+    that set mergeable are reset in each worker and the copies are sent
+    back and combined by merge, the same as mergeable sinks; anything the
+    other hooks gather stays in the workers.
+    """
+    mergeable = False
+
+    def reset(self):
+        """
+        Clears what the hook has gathered.  Only needed for mergeable hooks.
+        """
+        pass
+
+    def merge(self, other):
+        """
+        Folds in a copy of this hook that watched a different shard of a
+        parallel run.  Only needed for mergeable hooks.
+        """
+        raise Exception("no merge function defined")
+
+    def before_chunk(self, simulation, start, stop):
+        pass
+
+    def after_chunk(self, simulation, start, stop, columns):
+        pass
+
+    def before_node(self, simulation, key, start, stop):
+        pass
+
+    def after_node(self, simulation, key, start, stop, values):
+        """
+        @param values: the values just calculated for the node
+        """
+        pass
+
+class Sink(object):
+    """
+    Receives the results of a simulation one chunk of iterations at a time.
+
+    Sinks that set mergeable can be copied into each worker of a parallel
+    run, with the copies combined afterwards by merge.
+    """
+    mergeable = False
+
+    def begin(self, simulation, keys, iterations):
+        """
+        Called once before the first chunk.
+
+        @param keys: the names of the variables that will be in each chunk
+        @param iterations: the total number of iterations that will be written
+        """
+        pass
+
+    def write(self, start, stop, columns):
+        """
+        Called with each chunk, in order.
+
+        @param columns: a dict mapping each variable name to a numpy array
+                        of its values for iterations start through stop - 1
+        """
+        raise Exception("no write function defined")
+
+    def truncate(self, iterations):
+        """
+        Called before finish when a run stops short of the iterations begin
+        was given, as Simulation.run_adaptive does once its targets have
+        converged.  Sinks that lay out their output up front should shrink
+        it to the iterations actually written.
+        """
+        pass
+
+    def finish(self):
+        """
+        Called once after the last chunk.
+        """
+        pass
+
+    def merge(self, other):
+        """
+        Folds in a copy of this sink that was fed a different set of
+        iterations.  Only needed for mergeable sinks.
+        """
+        raise Exception("no merge function defined")
+
+class CsvSink(Sink):
+    """
+    Writes the space-delimited text format used by Simulation.save_output.
+    Importance sampled runs get a last column with the weight of each
+    iteration.
+    """
+    def __init__(self, outfile, keys=None):
+        """
+        @param keys: the variables to write, defaults to all of them
+        """
+        Sink.__init__(self)
+        self.outfile = outfile
+        self.keys = keys
+
+    def begin(self, simulation, keys, iterations):
+        if self.keys is None:
+            self.keys = list(keys)
+        self.f = open(self.outfile, "wb")
+        self.csvwriter = csv.writer(self.f, delimiter=" ")
+        self.names = output_keys(simulation, self.keys)
+        self.csvwriter.writerow(period_names(self.names, simulation.periods))
+
+    def write(self, start, stop, columns):
+        self.csvwriter.writerows(itertools.izip(*[x.tolist() for x in period_columns(self.names, columns)]))
+
+    def finish(self):
+        self.f.close()
+
+def weight_key(varname):
+    """
+    @return: the key the likelihood ratios of a biased random value go under
+             in the columns of a run, e.g. "x[weight]"
+    """
+    return varname + WEIGHT
+
+def iteration_weights(ratios):
+    """
+    Multiplies likelihood ratios together into the weight of each iteration.
+    In a simulation with more than one period the ratios of every period
+    count.
+
+    @param ratios: a list of arrays of likelihood ratios
+    @return: a 1-D numpy array, or None if there are no ratios
+    """
+    weights = None
+    for values in ratios:
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if values.ndim == 2:
+            values = values.prod(axis=1)
+        if weights is None:
+            weights = values.copy()
+        else:
+            weights = weights * values
+    return weights
+
+def output_keys(simulation, keys):
+    """
+    @return: the columns a sink writes for the given variables: the same,
+             followed by WEIGHT if the simulation is importance sampled
+    """
+    if simulation.importance_keys():
+        return list(keys) + [WEIGHT]
+    return list(keys)
+
+def period_names(keys, periods):
+    """
+    @return: the names of the columns of the given variables when each
+             period is a column of its own, e.g. "x[0]", "x[1]".  The weight
+             of each iteration is a single column.
+    """
+    if periods == 1:
+        return list(keys)
+    names = []
+    for key in keys:
+        if key == WEIGHT:
+            names.append(key)
+        else:
+            names.extend(["%s[%d]" % (key, period) for period in xrange(periods)])
+    return names
+
+def period_columns(keys, columns):
+    """
+    Splits the values of each variable into one column per period, in the
+    same order as period_names.
+
+    @return: a list of 1-D numpy arrays
+    """
+    result = []
+    for key in keys:
+        values = numpy.asarray(columns[key])
+        if values.ndim == 2:
+            result.extend([values[:, x] for x in xrange(values.shape[1])])
+        else:
+            result.append(values)
+    return result
+
+class ConvergenceTarget(object):
+    """
+    A precision goal for Simulation.run_adaptive: the mean or a percentile of
+    a variable, known to within a tolerance at a confidence level.
+    """
+    def __init__(self, variable, tolerance, percentile=None, relative=False, confidence=0.95, period=-1):
+        """
+        @param variable: the name of the variable to watch
+        @param tolerance: the largest acceptable half-width of the
+                          confidence interval
+        @param percentile: a probability between 0 and 1 to target that
+                           percentile, or None to target the mean
+        @param relative: treat the tolerance as a fraction of the estimate
+        @param confidence: the confidence level of the interval
+        @param period: the period to watch in a simulation with more than
+                       one, defaults to the last
+        """
+        object.__init__(self)
+        self.variable = variable
+        self.tolerance = tolerance
+        self.percentile = percentile
+        self.relative = relative
+        self.confidence = confidence
+        self.period = period
+        self.reset()
+
+    def reset(self):
+        self.batch_values = []
+
+    def add_batch(self, values, weights=None):
+        """
+        @param weights: the weight of each iteration of an importance
+                        sampled run
+        """
+        values = numpy.asarray(values)
+        if values.ndim == 2:
+            values = values[:, self.period]
+        if weights is not None and self.percentile is None:
+            self.batch_values.append(float(numpy.average(values, weights=weights)))
+        elif weights is not None:
+            self.batch_values.append(float(weighted_quantile(values, weights, self.percentile)))
+        elif self.percentile is None:
+            self.batch_values.append(float(numpy.mean(values)))
+        else:
+            self.batch_values.append(float(numpy.percentile(values, 100.0 * self.percentile)))
+
+    def estimate(self):
+        return numpy.mean(self.batch_values)
+
+    def half_width(self):
+        count = len(self.batch_values)
+        if count < 2:
+            return numpy.inf
+        spread = numpy.std(self.batch_values, ddof=1) / math.sqrt(count)
+        return student_t_ppf(0.5 + self.confidence / 2.0, count - 1) * spread
+
+    def converged(self):
+        limit = self.tolerance
+        if self.relative:
+            limit = limit * abs(self.estimate())
+        return self.half_width() <= limit
+
+    def report(self):
+        return {"variable": self.variable,
+                "statistic": self.percentile is None and "mean" or "p%g" % (100.0 * self.percentile),
+                "estimate": self.estimate(),
+                "half_width": self.half_width(),
+                "tolerance": self.tolerance,
+                "relative": self.relative,
+                "converged": self.converged()}
+
+def normal_ppf(p):
+    """
+    The inverse of the standard normal CDF, using Acklam's rational
+    approximation (relative error below 1.2e-9).  Works on arrays.
+    """
+    p = numpy.asarray(p, dtype=numpy.float64)
+    a = (-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02,
+         1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00)
+    b = (-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02,
+         6.680131188771972e+01, -1.328068155288572e+01)
+    c = (-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00,
+         -2.549732539343734e+00, 4.374664141464968e+00, 2.938163982698783e+00)
+    d = (7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00,
+         3.754408661907416e+00)
+    low = 0.02425
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        q = p - 0.5
+        r = q * q
+        central = (((((a[0] * r + a[1]) * r + a[2]) * r + a[3]) * r + a[4]) * r + a[5]) * q / \
+                  (((((b[0] * r + b[1]) * r + b[2]) * r + b[3]) * r + b[4]) * r + 1)
+        t = numpy.sqrt(-2 * numpy.log(numpy.minimum(p, 1 - p)))
+        tail = (((((c[0] * t + c[1]) * t + c[2]) * t + c[3]) * t + c[4]) * t + c[5]) / \
+               ((((d[0] * t + d[1]) * t + d[2]) * t + d[3]) * t + 1)
+        result = numpy.where(p < low, tail, numpy.where(p > 1 - low, -tail, central))
+    if result.ndim == 0:
+        return float(result)
+    return result
+
+def student_t_cdf(t, df):
+    """
+    The CDF of Student's t distribution with a whole number of degrees of
+    freedom, from the closed forms in Abramowitz and Stegun 26.7.3-4.
+    """
+    theta = math.atan2(t, math.sqrt(df))
+    cos2 = math.cos(theta) ** 2
+    if df % 2 == 1:
+        term = 1.0
+        total = 0.0
+        for k in xrange(1, (df - 1) // 2 + 1):
+            total = total + term
+            term = term * cos2 * (2.0 * k) / (2.0 * k + 1.0)
+        area = 2.0 / math.pi * (theta + math.sin(theta) * math.cos(theta) * total)
+    else:
+        term = 1.0
+        total = 0.0
+        for k in xrange(df // 2):
+            total = total + term
+            term = term * cos2 * (2.0 * k + 1.0) / (2.0 * k + 2.0)
+        area = math.sin(theta) * total
+    return 0.5 + area / 2.0
+
+def student_t_ppf(p, df):
+    """
+    The inverse CDF of Student's t distribution with a whole number of
+    degrees of freedom, found by bisecting student_t_cdf.
+    """
+    if p < 0.5:
+        return -student_t_ppf(1.0 - p, df)
+    high = 1.0
+    while student_t_cdf(high, df) < p:
+        high = high * 2.0
+    low = 0.0
+    for i in xrange(100):
+        middle = (low + high) / 2.0
+        if student_t_cdf(middle, df) < p:
+            low = middle
+        else:
+            high = middle
+        if high - low <= 1e-12 * high:
+            break
+    return (low + high) / 2.0
+
+def weighted_quantile(values, weights, q):
+    """
+    The quantiles of weighted samples, such as the values of a variable in
+    an importance sampled run along with Simulation.weights: the smallest
+    value with at least a share q of the total weight at or below it.
+
+    @param q: a probability between 0 and 1, or a list of them
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    order = numpy.argsort(values, kind="mergesort")
+    cumulative = numpy.cumsum(numpy.asarray(weights, dtype=numpy.float64)[order])
+    positions = numpy.searchsorted(cumulative, numpy.asarray(q, dtype=numpy.float64) * cumulative[-1])
+    return values[order][numpy.minimum(positions, len(values) - 1)]
+
+def evaluate_compiled(function, inputs, count, vectorized=False):
+    """
+    Applies an equation compiled by equationparser.compileEquation to count
+    iterations of its inputs.
+
+    @param inputs: the values of each argument of the function, in order
+    @param vectorized: call the function once on whole numpy arrays rather
+                       than once per iteration
+    @return: a float64 numpy array of the results
+    """
+    if vectorized:
+        values = numpy.empty(count, dtype=numpy.float64)
+        values[:] = function(*[numpy.asarray(x, dtype=numpy.float64) for x in inputs])
+        return values
+    inputs = [numpy.asarray(x).tolist() for x in inputs]
+    if inputs:
+        results = itertools.imap(function, *inputs)
+    else:
+        results = itertools.repeat(function(), count)
+    return numpy.fromiter(results, numpy.float64, count)
 
 class SimpleValue(object):
-    def __init__(self, name, units, comments=None):
+    """
+    Base class for the variables in a simulation.  Once calculated, the
+    samples are held in calculated_values as a contiguous float64 numpy
+    array with one entry per iteration, or in a simulation with more than
+    one period as an iterations x periods array in Fortran order, so the
+    values of each period are contiguous.
+    """
+    __slots__ = ("name", "units", "comments", "calculated_values", "calculated",
+                 "simulation", "varname", "initial")
+
+    def __init__(self, name, units, comments=None, initial=0.0):
+        """
+        @param initial: the value a lagged reference to this value gives
+                        for the periods before the first, e.g. x[t-1] in
+                        the first period
+        """
         object.__init__(self)
         self.name = name
         self.units = units
         self.comments = comments
-        self.calculated_values = []
+        self.initial = initial
+        self.calculated_values = numpy.empty(0, dtype=numpy.float64)
         self.calculated = False
 
     def calc(self):
         raise Exception("no calc function defined")
 
+    def definition(self):
+        raise Exception("no definition function defined")
+
 class RandomValue(SimpleValue):
-    def __init__(self, name, units, gen, comments=None):
-        SimpleValue.__init__(self, name, units, comments)
+    """
+    A value drawn from a RandomNumber.  If the generator is biased for
+    importance sampling, the likelihood ratios of the calculated values are
+    kept in likelihood, otherwise that is None.
+    """
+    __slots__ = ("gen", "likelihood")
+
+    def __init__(self, name, units, gen, comments=None, initial=0.0):
+        SimpleValue.__init__(self, name, units, comments, initial)
         self.gen = gen
+        self.likelihood = None
 
-    def calc(self, iterations=NUM_SIMULATIONS):
+    def calc(self, iterations=None):
+        if iterations is None:
+            iterations = self.simulation.iterations
+        columns = {}
         self.calculated = True
-        self.calculated_values = [self.gen.get() for x in xrange(NUM_SIMULATIONS)]
+        self.calculated_values = self.calc_range(0, iterations, columns)
+        self.likelihood = columns.get(weight_key(self.varname))
+
+    def definition(self):
+        return "RandomValue(%s)" % (self.gen.definition())
+
+    def calc_range(self, start, stop, columns=None):
+        """
+        Draws the samples for iterations start through stop - 1.  Each seed
+        block is drawn from its own stream, starting from the beginning of
+        the block, so a sample doesn't depend on how the run was split up.
+
+        @param columns: if the generator is biased, the likelihood ratios of
+                        the samples are put in here under weight_key(varname)
+        """
+        if isinstance(self.gen, RandomFixed):
+            return self.gen.get_many(stop - start)
+        if self.gen.biased():
+            values, ratios = self.calc_weighted(start, stop)
+            if columns is not None:
+                columns[weight_key(self.varname)] = ratios
+            return values
+        sampling = self.simulation.sampling
+        if sampling == "sobol":
+            return self.gen.ppf(self.simulation.sobol_uniforms(self.varname, start, stop))
+        values = numpy.empty(stop - start, dtype=numpy.float64)
+        for block in xrange(start // SEED_BLOCK_SIZE, (stop - 1) // SEED_BLOCK_SIZE + 1):
+            first = block * SEED_BLOCK_SIZE
+            last = min(stop, first + SEED_BLOCK_SIZE)
+            self.simulation.seed_stream(self.varname, block)
+            if sampling == "montecarlo":
+                samples = self.gen.get_many(self.block_draws(first, last))[max(start - first, 0):last - first]
+            else:
+                samples = self.gen.ppf(self.simulation.block_uniforms(last - first)[max(start - first, 0):])
+            values[max(first, start) - start:last - start] = samples
+        return values
+
+    def calc_weighted(self, start, stop):
+        """
+        The same as calc_range for a generator biased for importance
+        sampling, drawing from the same streams.
+
+        @return: the samples and their likelihood ratios
+        """
+        sampling = self.simulation.sampling
+        if sampling == "sobol":
+            return self.gen.ppf_weighted(self.simulation.sobol_uniforms(self.varname, start, stop))
+        values = numpy.empty(stop - start, dtype=numpy.float64)
+        ratios = numpy.empty(stop - start, dtype=numpy.float64)
+        for block in xrange(start // SEED_BLOCK_SIZE, (stop - 1) // SEED_BLOCK_SIZE + 1):
+            first = block * SEED_BLOCK_SIZE
+            last = min(stop, first + SEED_BLOCK_SIZE)
+            self.simulation.seed_stream(self.varname, block)
+            if sampling == "montecarlo":
+                samples, weights = self.gen.get_weighted(self.block_draws(first, last))
+                used = slice(max(start - first, 0), last - first)
+                samples, weights = samples[used], weights[used]
+            else:
+                uniforms = self.simulation.block_uniforms(last - first)[max(start - first, 0):]
+                samples, weights = self.gen.ppf_weighted(uniforms)
+            values[max(first, start) - start:last - start] = samples
+            ratios[max(first, start) - start:last - start] = weights
+        return values, ratios
+
+    def block_draws(self, first, last):
+        """
+        @return: how many samples to draw for a seed block that starts at
+                 first when the ones up to last are needed, which is the
+                 whole block if the samples depend on how many are drawn
+        """
+        if self.gen.consistent():
+            return last - first
+        return SEED_BLOCK_SIZE
 
 class RandomNumber(object):
     def __init__(self):
@@ -96,15 +1421,120 @@ class RandomNumber(object):
     def get(self):
         raise Exception("no get function defined")
 
+    def get_many(self, n):
+        """
+        Draws n samples at once.  Subclasses override this with a vectorized
+        version; by default it just calls get n times.
+
+        @return: a numpy array of n samples
+        """
+        return numpy.fromiter((self.get() for x in xrange(n)), numpy.float64, n)
+
+    def ppf(self, u):
+        """
+        The inverse of the cumulative distribution function, used by the
+        sampling methods other than plain Monte Carlo.
+
+        @param u: a numpy array of probabilities strictly between 0 and 1
+        @return: a numpy array of the matching values
+        """
+        raise Exception("no ppf function defined")
+
+    def consistent(self):
+        """
+        @return: whether the first samples drawn from the same random state
+                 are the same however many are drawn
+        """
+        return True
+
+    def biased(self):
+        """
+        @return: whether the samples are drawn from a proposal distribution
+                 rather than this one, for importance sampling
+        """
+        return False
+
+    def get_weighted(self, n):
+        """
+        Draws n samples for importance sampling.  They come from the
+        proposal distribution, and each one is weighted by its likelihood
+        ratio, its chance under this distribution over its chance under the
+        proposal, so weighted statistics estimate those of this
+        distribution.
+
+        @return: a numpy array of n samples and a numpy array of their ratios
+        """
+        return self.get_many(n), numpy.ones(n, dtype=numpy.float64)
+
+    def ppf_weighted(self, u):
+        """
+        The inverse CDF of the proposal distribution, for importance sampling
+        with the sampling methods other than plain Monte Carlo.
+
+        @return: numpy arrays of the matching values and of their ratios
+        """
+        return self.ppf(u), numpy.ones(len(u), dtype=numpy.float64)
+
+    def definition(self):
+        """
+        @return: a string that is the same for any two generators that draw
+                 the same values, used to identify cached results
+        """
+        return "%s(%s)" % (self.__class__.__name__,
+                           ", ".join(["%s=%r" % (key, val) for key, val in sorted(vars(self).iteritems())]))
+
 class RandomNormal(RandomNumber):
-    def __init__(self, mean, stdev):
+    def __init__(self, mean, stdev, shift=0.0, scale=1.0):
+        """
+        @param shift: for importance sampling, draw from a normal distribution
+                      whose mean is moved this many standard deviations, e.g.
+                      4.0 to oversample the upper tail
+        @param scale: for importance sampling, draw from a normal
+                      distribution this many times as wide, to oversample
+                      both tails
+        """
         RandomNumber.__init__(self)
         self.mean = mean
         self.stdev = stdev
+        self.shift = shift
+        self.scale = scale
+        if scale <= 0:
+            raise Exception("The scale of a normal proposal must be positive.")
+        if self.biased() and stdev <= 0:
+            raise Exception("A normal distribution with no spread can't be importance sampled.")
 
     def get(self):
         return random.normalvariate(self.mean, self.stdev)
 
+    def get_many(self, n):
+        return numpy.random.normal(self.mean, self.stdev, n)
+
+    def ppf(self, u):
+        return self.mean + self.stdev * normal_ppf(u)
+
+    def biased(self):
+        return self.shift != 0.0 or self.scale != 1.0
+
+    def get_weighted(self, n):
+        return self.weigh(numpy.random.normal(self.shift, self.scale, n))
+
+    def ppf_weighted(self, u):
+        return self.weigh(self.shift + self.scale * normal_ppf(u))
+
+    def weigh(self, z):
+        """
+        @param z: samples of the proposal, in standard deviations from the mean
+        @return: the samples and their likelihood ratios
+        """
+        ratios = self.scale * numpy.exp(0.5 * ((z - self.shift) / self.scale) ** 2 - 0.5 * z * z)
+        return self.mean + self.stdev * z, ratios
+
+    def definition(self):
+        if not self.biased():
+            # the same as before there were proposals, so cached results stay valid
+            return "RandomNormal(mean=%r, stdev=%r)" % (self.mean, self.stdev)
+        return RandomNumber.definition(self)
+
 class RandomTriangular(RandomNumber):
     """
     Triangular distributions require python 2.6.  Unfortunately, most
@@ -117,7 +1547,18 @@ class RandomTriangular(RandomNumber):
         self.high = high
 
     def get(self):
-        return random.triangular(self.low, self.med, self.high)
+        return random.triangular(self.low, self.high, self.med)
+
+    def get_many(self, n):
+        return numpy.random.triangular(self.low, self.med, self.high, n)
+
+    def ppf(self, u):
+        u = numpy.asarray(u, dtype=numpy.float64)
+        width = self.high - self.low
+        split = (self.med - self.low) / float(width)
+        return numpy.where(u < split,
+                           self.low + numpy.sqrt(u * width * (self.med - self.low)),
+                           self.high - numpy.sqrt((1 - u) * width * (self.high - self.med)))
 
 class RandomUniform(RandomNumber):
     def __init__(self, low, high):
@@ -128,6 +1569,13 @@ class RandomUniform(RandomNumber):
     def get(self):
         return random.uniform(self.low, self.high)
 
+    def get_many(self, n):
+        # same arithmetic as random.uniform, which also allows low > high
+        return self.low + (self.high - self.low) * numpy.random.random_sample(n)
+
+    def ppf(self, u):
+        return self.low + (self.high - self.low) * numpy.asarray(u, dtype=numpy.float64)
+
 class RandomFixed(RandomNumber):
     def __init__(self, val):
         object.__init__(self)
@@ -136,68 +1584,286 @@ class RandomFixed(RandomNumber):
     def get(self):
         return self.val
 
+    def get_many(self, n):
+        """
+        Returns a read-only view of the single value repeated n times, so no
+        storage is used per sample.
+        """
+        return numpy.broadcast_to(numpy.asarray(self.val, dtype=numpy.float64), (n,))
+
+    def ppf(self, u):
+        return self.get_many(len(u))
+
 class RandomTabular(RandomNumber):
     """
     Represents a random value that is based on a tabular outcome.  This is
     most useful for situations where there are dramatic outcomes relative
     to rare chance.  For example, periodic terrorist attacks.
+
+    Any chance not covered by the table gives 0.0.  Single draws bisect the
+    cumulative chances and batches use an alias table, so the cost of a
+    draw doesn't grow with the size of the table.
     """
-    # FIXME: I believe that Python may have a random routine built in that
-    # could address this sort of random number generation
-    def __init__(self, table):
+    def __init__(self, table, bias=None):
         """
         @param table: a set of tuples of either (chance, value) or (chance, RandomNumber)
+        @param bias: for importance sampling, a dict mapping the index of a
+                     row to the chance it should be drawn with instead, e.g.
+                     {2: 0.1} to draw a one in a million row one time in
+                     ten.  The other rows and the leftover chance share what
+                     is left over in proportion to their own chances.
         """
         self.table = table
+        self.bias = bias
 
-        totalChance = sum([x[0] for x in self.table])
-        if totalChance > 1:
+        # validate the table and build the cumulative chances in one pass
+        self.sumchances = []
+        totalChance = 0.0
+        for key, val in enumerate(self.table):
+            if len(val) != 2:
+                raise Exception("Row %d of the table is not a (chance, value) pair." % (key))
+            if val[0] < 0:
+                raise Exception("Row %d of the table has a negative chance." % (key))
+            totalChance = totalChance + val[0]
+            self.sumchances.append(totalChance)
+        # allow for rounding in chances that are meant to add up to exactly 1
+        if totalChance > 1 + 1e-9:
             raise Exception("Total chance of events is greater than 1.")
 
-        # create the lookup table for the random number generator
-        self.sumchances = []
-        for val in self.table:
-            if len(self.sumchances) == 0:
-                self.sumchances.append(val[0])
+        # the leftover chance is an extra row at the end that gives 0.0
+        chances = [x[0] for x in self.table] + [max(0.0, 1.0 - totalChance)]
+        self.prob, self.alias = self.build_alias(chances)
+        self.outcomes = numpy.array([0.0 if isinstance(x[1], RandomNumber) else x[1] for x in self.table] + [0.0],
+                                    dtype=numpy.float64)
+        self.nested = numpy.array([isinstance(x[1], RandomNumber) for x in self.table] + [False], dtype=bool)
+
+        # the same again for the proposal used by importance sampling, along
+        # with the likelihood ratio of each row
+        self.proposal = chances
+        if bias is not None:
+            self.proposal = self.build_proposal(chances, bias)
+        self.ratios = numpy.array([q and p / q or 0.0 for p, q in zip(chances, self.proposal)], dtype=numpy.float64)
+        self.bias_prob, self.bias_alias = self.build_alias(self.proposal)
+        self.bias_sums = list(numpy.cumsum(self.proposal[:-1]))
+
+    def definition(self):
+        # everything else is worked out from the table
+        bias = ""
+        if self.bias is not None:
+            bias = ", bias={%s}" % (", ".join(["%d: %r" % x for x in sorted(self.bias.iteritems())]))
+        return "RandomTabular(%s%s)" % (", ".join(["(%r, %s)" % (x[0], isinstance(x[1], RandomNumber) and
+                                                                 x[1].definition() or repr(x[1]))
+                                                   for x in self.table]), bias)
+
+    def build_alias(self, chances):
+        """
+        Builds the probability and alias arrays for Vose's alias method.
+
+        @param chances: the chance of each row, adding up to 1
+        """
+        count = len(chances)
+        total = sum(chances)
+        scaled = [x * count / total for x in chances]
+        prob = [1.0] * count
+        alias = range(count)
+        small = [key for key, val in enumerate(scaled) if val < 1.0]
+        large = [key for key, val in enumerate(scaled) if val >= 1.0]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            prob[less] = scaled[less]
+            alias[less] = more
+            scaled[more] = scaled[more] + scaled[less] - 1.0
+            if scaled[more] < 1.0:
+                small.append(more)
             else:
-                self.sumchances.append(val[0] + self.sumchances[-1])
+                large.append(more)
+        return numpy.array(prob, dtype=numpy.float64), numpy.array(alias, dtype=numpy.intp)
+
+    def build_proposal(self, chances, bias):
+        """
+        @param chances: the chance of each row, including the leftover row
+        @return: the chance of each row under the bias
+        """
+        for key, val in sorted(bias.iteritems()):
+            if not 0 <= key < len(self.table):
+                raise Exception("Row %s of the bias is not in the table." % (key))
+            if not 0 < val < 1:
+                raise Exception("The bias for row %d is not a chance between 0 and 1." % (key))
+            if chances[key] <= 0:
+                raise Exception("Row %d of the table has no chance, so it can't be biased." % (key))
+        rest = sum([x for key, x in enumerate(chances) if key not in bias])
+        left = 1.0 - sum(bias.values())
+        if left < 0 or (rest > 0 and left <= 0):
+            raise Exception("The biased rows leave no chance for the rest of the table.")
+        proposal = [key in bias and bias[key] or x * left / rest for key, x in enumerate(chances)]
+        return [x / sum(proposal) for x in proposal]
+
+    def consistent(self):
+        # the nested values are drawn after every row has been picked
+        return not self.nested.any()
+
+    def biased(self):
+        return self.bias is not None or True in [x[1].biased() for x in self.table if isinstance(x[1], RandomNumber)]
 
-    # FIXME: this is probably overly complex 
     def get(self):
-        thisval = random.random()
-        for key, val in enumerate(self.sumchances):
-            if thisval < val:
-                if isinstance(self.table[key][1], RandomNumber):
-                    return self.table[key][1].get()
-                return self.table[key][1]
-        return 0.0
+        key = bisect.bisect_right(self.sumchances, random.random())
+        if key == len(self.table):
+            return 0.0
+        if isinstance(self.table[key][1], RandomNumber):
+            return self.table[key][1].get()
+        return self.table[key][1]
+
+    def get_many(self, n):
+        """
+        Picks a row for every sample from the alias table and then fills in
+        the samples of rows that hold nested RandomNumbers, drawing each
+        with a single get_many call.
+        """
+        rows = self.pick_rows(n, self.prob, self.alias)
+        values = self.outcomes[rows]
+        self.fill_nested(rows, values)
+        return values
+
+    def get_weighted(self, n):
+        """
+        The same as get_many, but picking rows from the biased table.
+        """
+        rows = self.pick_rows(n, self.bias_prob, self.bias_alias)
+        values = self.outcomes[rows]
+        ratios = self.ratios[rows]
+        self.fill_nested(rows, values, ratios)
+        return values, ratios
+
+    def pick_rows(self, n, prob, alias):
+        # one uniform per draw: the integer part picks a column of the alias
+        # table and the fractional part decides between it and its alias
+        picks = numpy.random.random_sample(n) * len(prob)
+        columns = picks.astype(numpy.intp)
+        return numpy.where(picks - columns < prob[columns], columns, alias[columns])
+
+    def fill_nested(self, rows, values, ratios=None):
+        """
+        Draws the samples of the rows that hold nested RandomNumbers.  With
+        ratios they are importance sampled too, and their likelihood ratios
+        are multiplied into ratios.
+        """
+        hits = numpy.flatnonzero(self.nested[rows])
+        if len(hits):
+            hits = hits[numpy.argsort(rows[hits], kind="mergesort")]
+            keys, starts = numpy.unique(rows[hits], return_index=True)
+            ends = list(starts[1:]) + [len(hits)]
+            for key, start, end in zip(keys, starts, ends):
+                if ratios is None:
+                    values[hits[start:end]] = self.table[key][1].get_many(end - start)
+                else:
+                    samples, nested = self.table[key][1].get_weighted(end - start)
+                    values[hits[start:end]] = samples
+                    ratios[hits[start:end]] = ratios[hits[start:end]] * nested
+
+    def ppf(self, u):
+        """
+        Picks rows by where u falls in the cumulative chances.  For nested
+        RandomNumbers, u is rescaled to its position within the row and
+        passed on, so stratification carries through to the nested values.
+        """
+        return self.ppf_rows(u, self.sumchances, [x[0] for x in self.table])
+
+    def ppf_weighted(self, u):
+        return self.ppf_rows(u, self.bias_sums, self.proposal, True)
+
+    def ppf_rows(self, u, sums, chances, weighted=False):
+        u = numpy.asarray(u, dtype=numpy.float64)
+        rows = numpy.searchsorted(sums, u, side="right")
+        values = self.outcomes[rows]
+        ratios = None
+        if weighted:
+            ratios = self.ratios[rows]
+        for key in numpy.flatnonzero(self.nested[:len(self.table)]):
+            hits = numpy.flatnonzero(rows == key)
+            if len(hits):
+                below = key and sums[key - 1] or 0.0
+                inner = numpy.clip((u[hits] - below) / chances[key], 1e-16, 1 - 1e-16)
+                if weighted:
+                    values[hits], nested = self.table[key][1].ppf_weighted(inner)
+                    ratios[hits] = ratios[hits] * nested
+                else:
+                    values[hits] = self.table[key][1].ppf(inner)
+        if weighted:
+            return values, ratios
+        return values
 
 class CalculatedValue(SimpleValue):
-    def __init__(self, name, units, equation, comments=None):
-        SimpleValue.__init__(self, name, units, comments)
-        self.equation = equation
-        # print "Equation: ", self.equation
-        self.parsed_equation = equationparser.parseEquation(self.equation)
-        # print "Parsed: ", self.parsed_equation
+    __slots__ = ("equation", "parsed_equation", "variables", "lags", "compiled_equation")
+
+    def __init__(self, name, units, equation, comments=None, parsed=None, initial=0.0):
+        """
+        @param parsed: the equation already parsed, e.g. from a compiled
+                       model (see simmodel), so it isn't parsed again
+        """
+        SimpleValue.__init__(self, name, units, comments, initial)
+        self.set_equation(equation, parsed)
+        # print "Variables: ", self.variables
+
+    def set_equation(self, equation, parsed=None):
+        """
+        Parses and compiles a new equation for this value.  If the equation
+        doesn't parse or compile the value is left as it was.
+        """
+        # print "Equation: ", equation
+        if parsed is None:
+            parsed = equationparser.parseEquation(equation)
+        parsed = equationparser.Expression(parsed)
+        # print "Parsed: ", parsed
         # this is a clear hack...
-        self.variables = equationparser.getVariables(self.parsed_equation)
+        variables = equationparser.getVariables(parsed)
+        lags = equationparser.getLags(parsed)
+        compiled = equationparser.compileEquation(parsed)
+        self.equation = equation
+        self.parsed_equation = parsed
+        self.variables = variables
+        self.lags = lags
+        self.compiled_equation = compiled
         self.calculated = False
-        # print "Variables: ", self.variables
+
+    def definition(self):
+        # the parsed form, so spacing and redundant brackets don't matter
+        return "CalculatedValue(%s)" % (" ".join(self.parsed_equation))
 
     def calc(self):
         """
-        This is horribly inefficient for calculation right now as it generates
-        and reparses an equation for each calculation.  I just don't want to
-        write a better calculator right now.
+        Calculates the value of the equation for every iteration.  The
+        equation is compiled to a Python function when the value is created,
+        so each iteration only costs the arithmetic.
         """
         if False not in [self.simulation.variables[x].calculated for x in self.variables]:
             # print "Variables and Status: ", self.variables, [self.simulation.variables[x].calculated for x in self.variables]
-            for iter in xrange(NUM_SIMULATIONS):
-                # print "Round %d!" % (iter)
-                # print "Eqn: %s" % (self.parsed_equation)
-                self.calculated_values.append(equationparser.evaluateEquation(self.parsed_equation, iter, self.simulation.variables))
-                # self.calculated_values.append(equationparser.evaluateStack(self.parsed_equation, iter, self.simulation.variables))
+            columns = dict((x, self.simulation.variables[x].calculated_values) for x in self.variables)
+            self.calculated_values = self.calc_range(0, self.simulation.iterations, columns)
             self.calculated = True
             return True
         else:
             return False
+
+    def calc_range(self, start, stop, columns):
+        """
+        Calculates iterations start through stop - 1.
+
+        @param columns: a dict mapping each input variable to its values for
+                        the same iterations
+        """
+        if self.simulation.vectorized:
+            return self.calc_vectorized(start, stop, columns)
+        return evaluate_compiled(self.compiled_equation, [columns[x] for x in self.compiled_equation.variables],
+                                 stop - start)
+
+    def calc_vectorized(self, start, stop, columns):
+        """
+        Evaluates the parsed equation once over the full columns of the input
+        variables rather than once per iteration.
+        """
+        columns = dict((x, numpy.asarray(columns[x], dtype=numpy.float64))
+                       for x in self.variables + [y[0] for y in self.lags])
+        values = numpy.empty(stop - start, dtype=numpy.float64)
+        values[:] = equationparser.evaluateColumn(self.parsed_equation, columns)
+        return values
@@ -0,0 +1,104 @@
+"""
+Copyright (c) 2010 Patrick Wagstrom
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+# Tests for the binary output writers.  Run with:
+#
+#     python -m unittest discover -p "test_*.py"
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+import simoutput
+from stochasticsim import ConvergenceTarget
+from testsupport import build_simulation
+
+MAX_ITERATIONS = 50000
+BATCH_SIZE = 1000
+KEYS = ("x", "y", "z")
+
+class EarlyStopTest(unittest.TestCase):
+    """
+    Each binary sink handed to run_adaptive should hold exactly the
+    iterations the run used when its targets converge early.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="test_simoutput")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_adaptive(self, sink, periods=1):
+        sim = build_simulation(periods)
+        sim.run_adaptive([ConvergenceTarget("y", 0.5)], batch_size=BATCH_SIZE, max_iterations=MAX_ITERATIONS,
+                         min_batches=3, sinks=[sink])
+        self.assertTrue(sim.convergence["converged"])
+        self.assertTrue(sim.iterations < MAX_ITERATIONS)
+        return sim
+
+    def check_columns(self, sim, columns):
+        for key in KEYS:
+            self.assertEqual(columns[key].shape, sim.variables[key].calculated_values.shape)
+            self.assertTrue(numpy.array_equal(columns[key], sim.variables[key].calculated_values))
+
+    def check_raw(self, periods):
+        outfile = os.path.join(self.directory, "out.raw")
+        sim = self.run_adaptive(simoutput.RawSink(outfile), periods)
+        header = simoutput.read_raw_header(outfile)
+        self.assertEqual(header["iterations"], sim.iterations)
+        self.check_columns(sim, simoutput.load_raw(outfile))
+        self.assertFalse(os.path.exists(outfile + ".tmp"))
+
+    def check_npy(self, periods):
+        directory = os.path.join(self.directory, "out") + os.sep
+        sim = self.run_adaptive(simoutput.NpySink(directory), periods)
+        self.check_columns(sim, dict((key, numpy.load(os.path.join(directory, key + ".npy"))) for key in KEYS))
+        self.assertEqual(sorted(os.listdir(directory)), [key + ".npy" for key in KEYS])
+
+    def check_npz(self, periods):
+        outfile = os.path.join(self.directory, "out.npz")
+        sim = self.run_adaptive(simoutput.NpzSink(outfile), periods)
+        archive = numpy.load(outfile)
+        try:
+            self.check_columns(sim, dict((key, archive[key]) for key in KEYS))
+        finally:
+            archive.close()
+
+    def test_raw(self):
+        self.check_raw(1)
+
+    def test_raw_periods(self):
+        self.check_raw(3)
+
+    def test_npy(self):
+        self.check_npy(1)
+
+    def test_npy_periods(self):
+        self.check_npy(3)
+
+    def test_npz(self):
+        self.check_npz(1)
+
+    def test_npz_periods(self):
+        self.check_npz(3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,190 @@
+"""
+Copyright (c) 2010 Patrick Wagstrom
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+# Tests for the simulation engine.  Run with:
+#
+#     python -m unittest discover -p "test_*.py"
+import unittest
+import numpy
+import simplan
+from stochasticsim import RandomValue, RandomNormal, RandomUniform, CalculatedValue, Hook
+from testsupport import build_simulation
+
+class SetEquationTest(unittest.TestCase):
+    """
+    A bad equation should leave the variable and the simulation as they
+    were.
+    """
+    def check_unchanged(self, equation, optimize=False):
+        sim = build_simulation()
+        if optimize:
+            simplan.optimize(sim, outputs=["z"])
+        sim.run()
+        variable = sim.variables["y"]
+        before = (variable.equation, tuple(variable.parsed_equation), list(variable.variables), variable.lags,
+                  variable.compiled_equation, variable.calculated, variable.calculated_values.copy())
+        order, plan = sim.order, sim.plan
+        self.assertRaises(Exception, sim.set_equation, "y", equation)
+        self.assertEqual(variable.equation, before[0])
+        self.assertEqual(tuple(variable.parsed_equation), before[1])
+        self.assertEqual(variable.variables, before[2])
+        self.assertEqual(variable.lags, before[3])
+        self.assertEqual(variable.calculated, before[5])
+        self.assertTrue(numpy.array_equal(variable.calculated_values, before[6]))
+        self.assertEqual(sim.order, order)
+        self.assertTrue(sim.plan is plan)
+        # and the old equation still works
+        sim.recalculate(["y"])
+        self.assertTrue(numpy.array_equal(variable.calculated_values, before[6]))
+
+    def test_unparseable(self):
+        self.check_unchanged("x +")
+
+    def test_unparseable_value(self):
+        variable = CalculatedValue("y", "units", "x * 2")
+        compiled = variable.compiled_equation
+        self.assertRaises(Exception, variable.set_equation, "x y")
+        self.assertEqual(variable.equation, "x * 2")
+        self.assertEqual(variable.variables, ["x"])
+        self.assertTrue(variable.compiled_equation is compiled)
+
+    def test_undefined_name(self):
+        self.check_unchanged("w * 2")
+
+    def test_cycle(self):
+        self.check_unchanged("z * 2")
+
+    def test_with_plan(self):
+        self.check_unchanged("w * 2", optimize=True)
+        self.check_unchanged("x +", optimize=True)
+
+class FailingHook(Hook):
+    """
+    Fails once the given variable has been calculated, so a recalculation
+    gets partway through.
+    """
+    def __init__(self, key):
+        Hook.__init__(self)
+        self.key = key
+
+    def after_node(self, simulation, key, start, stop, values):
+        if key == self.key:
+            raise Exception("failed after " + key)
+
+class RecalculateFailureTest(unittest.TestCase):
+    """
+    When the recalculation after a change fails, the change should be undone
+    and every result put back.
+    """
+    def setUp(self):
+        self.sim = build_simulation()
+        self.plan = simplan.optimize(self.sim, outputs=["z"])
+        self.sim.run()
+        self.before = dict((key, (val.calculated, val.calculated_values))
+                           for key, val in self.sim.variables.iteritems())
+        self.sim.hooks.append(FailingHook("z"))
+
+    def check_unchanged(self):
+        self.assertTrue(self.sim.plan is self.plan)
+        for key, (calculated, values) in self.before.iteritems():
+            self.assertEqual(self.sim.variables[key].calculated, calculated)
+            self.assertTrue(self.sim.variables[key].calculated_values is values)
+
+    def test_set_equation(self):
+        self.assertRaises(Exception, self.sim.set_equation, "y", "x * 3")
+        self.assertEqual(self.sim.variables["y"].equation, "x * 2")
+        self.assertEqual(self.sim.variables["y"].variables, ["x"])
+        self.check_unchanged()
+
+    def test_set_generator(self):
+        gen = self.sim.variables["x"].gen
+        self.assertRaises(Exception, self.sim.set_generator, "x", RandomUniform(0.0, 1.0))
+        self.assertTrue(self.sim.variables["x"].gen is gen)
+        self.check_unchanged()
+
+    def test_replace_variable(self):
+        variable = self.sim.variables["y"]
+        self.assertRaises(Exception, self.sim.replace_variable, "y", CalculatedValue("y", "units", "x * 3"))
+        self.assertTrue(self.sim.variables["y"] is variable)
+        self.check_unchanged()
+
+    def test_not_run(self):
+        sim = build_simulation()
+        self.assertRaises(Exception, sim.set_equation, "y", "x * 3")
+        self.assertEqual(sim.variables["y"].equation, "x * 2")
+        self.assertFalse(sim.variables["y"].calculated)
+
+class PrunedPlanTest(unittest.TestCase):
+    """
+    Under a plan that prunes some variables, changing a kept variable should
+    recalculate it and rebuild the plan, while changing a pruned one should
+    fail before anything is touched.
+    """
+    def setUp(self):
+        self.sim = build_simulation()
+        self.sim.add_variable("w", RandomValue("w", "units", RandomNormal(0.0, 1.0)))
+        self.sim.add_variable("v", CalculatedValue("v", "units", "w + z"))
+        self.plan = simplan.optimize(self.sim, outputs=["z"])
+        self.sim.run()
+
+    def test_set_generator(self):
+        gen = self.sim.variables["w"].gen
+        self.assertRaises(Exception, self.sim.set_generator, "w", RandomUniform(0.0, 1.0))
+        self.assertTrue(self.sim.variables["w"].gen is gen)
+        self.assertTrue(self.sim.plan is self.plan)
+
+    def test_set_equation(self):
+        self.assertRaises(Exception, self.sim.set_equation, "v", "w * z")
+        self.assertEqual(self.sim.variables["v"].equation, "w + z")
+        self.assertTrue(self.sim.plan is self.plan)
+
+    def check_matches_run(self, definitions):
+        # the same model run from scratch
+        sim = build_simulation()
+        sim.add_variable("w", RandomValue("w", "units", RandomNormal(0.0, 1.0)))
+        sim.add_variable("v", CalculatedValue("v", "units", "w + z"))
+        for key, equation in definitions.iteritems():
+            sim.variables[key].set_equation(equation)
+        sim.run()
+        for key in self.sim.plan.variables:
+            self.assertTrue(numpy.array_equal(self.sim.variables[key].calculated_values,
+                                              sim.variables[key].calculated_values))
+
+    def test_set_equation_kept(self):
+        self.assertEqual(self.sim.set_equation("y", "x * 3"), ["y", "z"])
+        self.assertEqual(self.sim.plan.outputs, ["z"])
+        self.assertEqual(self.sim.plan.dropped, ["w", "v"])
+        self.check_matches_run({"y": "x * 3"})
+
+    def test_set_equation_needs_dropped(self):
+        # y now reads w, which the old plan dropped and never calculated
+        self.assertEqual(self.sim.set_equation("y", "x * 3 + w"), ["w", "y", "z"])
+        self.assertEqual(self.sim.plan.dropped, ["v"])
+        self.check_matches_run({"y": "x * 3 + w"})
+
+    def test_set_generator_kept(self):
+        self.assertEqual(self.sim.set_generator("x", RandomUniform(0.0, 1.0)), ["x", "y", "z"])
+        self.assertEqual(self.sim.plan.dropped, ["w", "v"])
+        self.assertTrue(numpy.array_equal(self.sim.variables["y"].calculated_values,
+                                          self.sim.variables["x"].calculated_values * 2))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,33 @@
+"""
+Copyright (c) 2010 Patrick Wagstrom
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+# Fixtures shared by the test_*.py modules.
+from stochasticsim import Simulation, RandomValue, RandomNormal, CalculatedValue
+
+def build_simulation(periods=1, iterations=1000):
+    """
+    @return: a small simulation of a random value x, y = x * 2 and z = y + 1
+    """
+    sim = Simulation(vectorized=True, seed=1, iterations=iterations, periods=periods)
+    sim.add_variable("x", RandomValue("x", "units", RandomNormal(10.0, 1.0)))
+    sim.add_variable("y", CalculatedValue("y", "units", "x * 2"))
+    sim.add_variable("z", CalculatedValue("z", "units", "y + 1"))
+    return sim